@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import os
+import re
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+import uuid
+from tracecontext import BaseTraceparent, BufferedRandomIdGenerator, CompactTraceparent, CompactTracestate, FrozenTraceparent, ParseCache, ParseFailure, RandomIdGenerator, Traceparent, Tracestate, TracestateKeyRegistry, parse_traceparents
+
+TRACEPARENT = '00-12345678901234567890123456789012-1234567890123456-01'
+
+def measure(func, number = 100000, repeat = 5):
+	return number / min(timeit.repeat(func, number = number, repeat = repeat))
+
+def measure_threads(func, threads, number = 100000):
+	# returns the average rate per thread while all threads run concurrently
+	barrier = threading.Barrier(threads)
+	rates = []
+	def worker():
+		barrier.wait()
+		start = time.perf_counter()
+		for _ in range(number):
+			func()
+		rates.append(number / (time.perf_counter() - start))
+	workers = [threading.Thread(target = worker) for _ in range(threads)]
+	for thread in workers:
+		thread.start()
+	for thread in workers:
+		thread.join()
+	return sum(rates) / threads
+
+def measure_memory(factory, inputs):
+	# keep every object alive while the allocations are being traced
+	tracemalloc.start()
+	try:
+		before = tracemalloc.get_traced_memory()[0]
+		objects = list(map(factory, inputs))
+		after = tracemalloc.get_traced_memory()[0]
+	finally:
+		tracemalloc.stop()
+	return (after - before) / len(objects)
+
+def report(name, rate, unit = 'ops/sec'):
+	print('{:<56} {:>14,.0f} {}'.format(name, rate, unit))
+
+def bench_traceparent_from_string():
+	'''
+	headers/sec for Traceparent.from_string, generic split-and-setters path vs the version 00 fast path
+	'''
+	value = TRACEPARENT
+	report('BaseTraceparent(*value.split(\'-\'))', measure(lambda: BaseTraceparent(*value.split('-'))), 'headers/sec')
+	report('BaseTraceparent.from_string(value)', measure(lambda: BaseTraceparent.from_string(value)), 'headers/sec')
+	report('Traceparent(*value.split(\'-\'))', measure(lambda: Traceparent(*value.split('-'))), 'headers/sec')
+	report('Traceparent.from_string(value)', measure(lambda: Traceparent.from_string(value)), 'headers/sec')
+	raw = value.encode('ascii')
+	report('Traceparent.from_string(str(raw, \'ascii\'))', measure(lambda: Traceparent.from_string(str(raw, 'ascii'))), 'headers/sec')
+	report('Traceparent.from_string(raw)', measure(lambda: Traceparent.from_string(raw)), 'headers/sec')
+
+def bench_memory():
+	'''
+	bytes per live object, including the decoded ids and members, regular vs compact classes
+	'''
+	count = 10000
+	traceparents = ['00-{}-{}-01'.format(os.urandom(16).hex(), os.urandom(8).hex()) for _ in range(count)]
+	tracestates = ['congo={},rojo={},tenant@system={}'.format(idx, idx * 2, idx * 3) for idx in range(count)]
+	report('Traceparent', measure_memory(Traceparent.from_string, traceparents), 'bytes/object')
+	report('CompactTraceparent', measure_memory(CompactTraceparent.from_string, traceparents), 'bytes/object')
+	report('Tracestate (3 members)', measure_memory(Tracestate, tracestates), 'bytes/object')
+	report('CompactTracestate (3 members)', measure_memory(CompactTracestate, tracestates), 'bytes/object')
+
+def bench_id_generator():
+	'''
+	trace_id + parent_id pairs/sec per thread, uuid based ids vs IdGenerator implementations
+	'''
+	random_generator = RandomIdGenerator()
+	buffered_generator = BufferedRandomIdGenerator()
+	candidates = [
+		('uuid.uuid1().hex, uuid.uuid4().hex[:16]', lambda: (uuid.uuid1().hex, uuid.uuid4().hex[:16])),
+		('RandomIdGenerator', lambda: (random_generator.generate_trace_id(), random_generator.generate_parent_id())),
+		('BufferedRandomIdGenerator', lambda: (buffered_generator.generate_trace_id(), buffered_generator.generate_parent_id())),
+		('Traceparent()', Traceparent),
+	]
+	for threads in (1, 4):
+		for name, func in candidates:
+			report('{} x{} threads'.format(name, threads), measure_threads(func, threads), 'ids/sec/thread')
+
+def bench_batch():
+	'''
+	headers/sec for one Traceparent.from_string per value vs parse_traceparents, with 10% invalid values
+	'''
+	values = ['00-{}-{}-01'.format(os.urandom(16).hex(), os.urandom(8).hex()) for _ in range(9000)]
+	values += ['00-{}-{}-01'.format(os.urandom(15).hex(), os.urandom(8).hex()) for _ in range(1000)]
+	buffer = '\n'.join(values).encode('ascii')
+	def one_by_one():
+		for value in values:
+			try:
+				Traceparent.from_string(value)
+			except ValueError:
+				pass
+	report('Traceparent.from_string per value', measure(one_by_one, number = 10) * len(values), 'headers/sec')
+	report('parse_traceparents(list)', measure(lambda: parse_traceparents(values), number = 10) * len(values), 'headers/sec')
+	report('parse_traceparents(bytes)', measure(lambda: parse_traceparents(buffer), number = 10) * len(values), 'headers/sec')
+
+def bench_traceparent_index():
+	'''
+	lookups/sec in a span index of 1000 traceparents, keyed by the header string vs by FrozenTraceparent
+	'''
+	compacts = [CompactTraceparent() for _ in range(1000)]
+	frozens = [FrozenTraceparent.from_traceparent(traceparent.to_traceparent()) for traceparent in compacts]
+	by_string = {str(traceparent): idx for idx, traceparent in enumerate(compacts)}
+	by_frozen = {traceparent: idx for idx, traceparent in enumerate(frozens)}
+	by_trace_id = {traceparent.trace_id_int: idx for idx, traceparent in enumerate(frozens)}
+	report('index[str(CompactTraceparent)]', measure(lambda: [by_string[str(traceparent)] for traceparent in compacts], number = 200) * len(compacts), 'lookups/sec')
+	report('index[FrozenTraceparent]', measure(lambda: [by_frozen[traceparent] for traceparent in frozens], number = 200) * len(frozens), 'lookups/sec')
+	report('index[FrozenTraceparent.trace_id_int]', measure(lambda: [by_trace_id[traceparent.trace_id_int] for traceparent in frozens], number = 200) * len(frozens), 'lookups/sec')
+
+def bench_traceparent_to_string():
+	'''
+	serializations/sec, uncached formatting vs the cached header vs deriving and serializing a child per hop
+	'''
+	traceparent = Traceparent.from_string(TRACEPARENT)
+	def uncached():
+		traceparent._string = None
+		return traceparent.to_string()
+	report('to_string() without cache', measure(uncached), 'serializations/sec')
+	report('to_string() cached', measure(traceparent.to_string), 'serializations/sec')
+	report('str(Traceparent(0, trace_id, None, trace_flags))', measure(lambda: str(Traceparent(0, traceparent.trace_id, None, traceparent.trace_flags))), 'serializations/sec')
+	report('str(traceparent.child())', measure(lambda: str(traceparent.child())), 'serializations/sec')
+
+def bench_tracestate_forward():
+	'''
+	hops/sec for copying a 32 member tracestate, updating one key and serializing it
+	'''
+	state = Tracestate(','.join('vendor{}=value{}'.format(idx, idx) for idx in range(32)))
+	state.to_string()
+	def full_copy():
+		# what every hop paid before copy-on-write: a full OrderedDict copy and a rebuilt header
+		copy = Tracestate(OrderedDict(state._items()))
+		copy['vendor0'] = 'updated'
+		return copy.to_string()
+	def copy_on_write():
+		copy = Tracestate(state)
+		copy['vendor0'] = 'updated'
+		return copy.to_string()
+	report('full copy + rebuilt header', measure(full_copy), 'hops/sec')
+	report('copy-on-write + incremental header', measure(copy_on_write), 'hops/sec')
+
+def bench_tracestate_lazy():
+	'''
+	headers/sec for forwarding a 32 member tracestate unchanged after checking is_valid, eager vs lazy parsing
+	'''
+	header = ','.join('vendor{}=value'.format(idx) for idx in range(32))
+	def eager():
+		state = Tracestate(header)
+		return state.is_valid() and state.to_string()
+	def lazy():
+		state = Tracestate.lazy(header)
+		return state.is_valid() and state.to_string()
+	report('Tracestate(header)', measure(eager, number = 10000), 'headers/sec')
+	report('Tracestate.lazy(header)', measure(lazy), 'headers/sec')
+
+def bench_tracestate_truncate():
+	'''
+	truncations/sec of a worst case 32 x 256 characters tracestate down to 512 bytes, pop loop vs truncate
+	'''
+	members = [('vendor{}'.format(idx), 'x' * (256 - len('vendor{}='.format(idx)))) for idx in range(32)]
+	def pop_loop():
+		state = Tracestate(members)
+		while len(state) and not state.is_valid():
+			state.pop()
+		return state
+	def pop_loop_uncached():
+		# the pop loop as it was before the header was cached, rebuilding it on every is_valid
+		state = Tracestate(members)
+		while len(state) and not state.is_valid():
+			state.pop()
+			state._string = None
+		return state
+	def truncate():
+		state = Tracestate(members)
+		state.truncate()
+		return state
+	report('while not is_valid(): pop() (rebuilt header)', measure(pop_loop_uncached, number = 10000), 'truncations/sec')
+	report('while not is_valid(): pop() (cached header)', measure(pop_loop, number = 10000), 'truncations/sec')
+	report('truncate()', measure(truncate, number = 10000), 'truncations/sec')
+
+def bench_tracestate_key_registry():
+	'''
+	headers/sec for parsing a tracestate of well known vendor keys, with and without a key registry, and sets/sec of a known key
+	'''
+	keys = ['congo', 'rojo', 'tenant@system', 'fw529a3039@dt', 'vendor']
+	header = ','.join('{}={:016x}'.format(key, idx) for idx, key in enumerate(keys))
+	class RegistryTracestate(Tracestate):
+		key_registry = TracestateKeyRegistry(keys)
+	class InterningTracestate(Tracestate):
+		key_registry = TracestateKeyRegistry(keys, intern_parsed = True)
+	report('Tracestate(header)', measure(lambda: Tracestate(header)), 'headers/sec')
+	report('Tracestate(header) with key_registry', measure(lambda: RegistryTracestate(header)), 'headers/sec')
+	report('Tracestate(header) with key_registry, intern_parsed', measure(lambda: InterningTracestate(header)), 'headers/sec')
+	state = Tracestate()
+	registry_state = RegistryTracestate()
+	def set_known(state):
+		state['tenant@system'] = '1'
+	report('state[key] = value', measure(lambda: set_known(state)), 'sets/sec')
+	report('state[key] = value with key_registry', measure(lambda: set_known(registry_state)), 'sets/sec')
+
+def bench_parse_cache():
+	'''
+	headers/sec for parsing the same traceparent and tracestate again, with and without a parse cache
+	'''
+	header = 'congo=t61rcWkgMzE,rojo=00f067aa0ba902b7,tenant@system=1,vendor=' + 'x' * 64
+	class CachedTraceparent(Traceparent):
+		parse_cache = ParseCache()
+	class CachedTracestate(Tracestate):
+		parse_cache = ParseCache()
+	report('Traceparent.from_string(value)', measure(lambda: Traceparent.from_string(TRACEPARENT)), 'headers/sec')
+	report('Traceparent.from_string(value) with parse_cache', measure(lambda: CachedTraceparent.from_string(TRACEPARENT)), 'headers/sec')
+	report('Tracestate(header)', measure(lambda: Tracestate(header)), 'headers/sec')
+	report('Tracestate(header) with parse_cache', measure(lambda: CachedTracestate(header)), 'headers/sec')
+	report('Tracestate(header).to_string() with parse_cache', measure(lambda: CachedTracestate(header).to_string()), 'headers/sec')
+	for threads in (1, 4):
+		report('Tracestate(header) with parse_cache x{} threads'.format(threads), measure_threads(lambda: CachedTracestate(header), threads), 'headers/sec/thread')
+	report('parse_cache hit rate', CachedTracestate.parse_cache.hit_rate() * 100, '%')
+
+def bench_tracestate_adversarial():
+	'''
+	bytes/sec for hostile tracestate headers, unbounded and with a member budget, fails unless the time grows linearly
+	'''
+	cases = [
+		('huge header', lambda size: ('vendor=value,' * (size // 13 + 1))[:size]),
+		('empty members', lambda size: ',' * size),
+		('OWS run', lambda size: 'congo=1' + ' \t' * (size // 2) + 'x'),
+		('value backtracking', lambda size: ','.join('k{}='.format(idx) + ' ' * 255 + 'x' for idx in range(size // 262)) + ',k=' + ' ' * 300),
+	]
+	for name, make in cases:
+		rates = []
+		for size in (16384, 65536):
+			header = make(size)
+			rates.append(measure(lambda: Tracestate.try_parse(header), number = 10, repeat = 3) * len(header))
+		report('{} ({} bytes)'.format(name, len(header)), rates[-1], 'bytes/sec')
+		report('{} ({} bytes), max_members = 32'.format(name, len(header)), measure(lambda: Tracestate.try_parse(header, max_members = 32), number = 10, repeat = 3) * len(header), 'bytes/sec')
+		# 4x the bytes must take less than 8x the time
+		assert rates[1] > rates[0] / 2, '{} does not parse in linear time'.format(name)
+	# what the OWS run cost when members were split with a regular expression, which backtracks over the whole run at every position
+	header = cases[2][1](16384)
+	report('OWS run ({} bytes), re.split (before)'.format(len(header)), measure(lambda: re.split('[ \t]*,[ \t]*', header), number = 1, repeat = 1) * len(header), 'bytes/sec')
+
+def bench_tracestate_tokenize():
+	'''
+	headers/sec for the tracestate corpora, split then match then dedupe (before) vs a single tokenizing pass
+	'''
+	import contextlib
+	import io
+	from tracecontext.test_tracestate import HEADERS
+	corpora = [('test_tracestate.py', HEADERS)]
+	# the TraceContextTest corpus comes from the harness, which needs aiohttp and prints the levels when imported
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			from load import load_corpus
+			harness = [value for headers in load_corpus() for key, value in headers if key.lower() == 'tracestate']
+		corpora.append(('TraceContextTest', harness))
+	except ImportError as err:
+		print('skipping the TraceContextTest corpus: {}'.format(err))
+	from tracecontext.tracestate import _tokenize
+	member_match = re.compile('(%s)=(%s)' % (Tracestate._KEY_FORMAT, Tracestate._VALUE_FORMAT)).fullmatch
+	def three_pass(header):
+		members = {}
+		for member in re.split('[ \t]*,[ \t]*', header):
+			if member:
+				match = member_match(member)
+				if not match:
+					return None
+				members.setdefault(match.group(1), match.group(2))
+		return members
+	for name, headers in corpora:
+		report('{} ({} headers), before'.format(name, len(headers)), measure(lambda: [three_pass(header) for header in headers], number = 2000) * len(headers), 'headers/sec')
+		report('{} ({} headers), _tokenize'.format(name, len(headers)), measure(lambda: [list(_tokenize(header)) for header in headers], number = 2000) * len(headers), 'headers/sec')
+		report('{} ({} headers), Tracestate.try_parse'.format(name, len(headers)), measure(lambda: [Tracestate.try_parse(header) for header in headers], number = 2000) * len(headers), 'headers/sec')
+
+def bench_try_parse():
+	'''
+	headers/sec for rejecting invalid headers, from_string with except ValueError vs try_parse
+	'''
+	traceparents = [
+		'00-1234567890123456789012345678901-1234567890123456-01',
+		'00-00000000000000000000000000000000-1234567890123456-01',
+		'ff-12345678901234567890123456789012-1234567890123456-01',
+		'garbage',
+	]
+	tracestates = ['congo=1,rojo=2,FOO=3', 'congo=1,rojo', '=' * 64]
+	def reject(parse, values):
+		def run():
+			for value in values:
+				try:
+					parse(value)
+				except ValueError:
+					pass
+		return run
+	def try_reject(try_parse, values):
+		def run():
+			return [value for value in values if isinstance(try_parse(value), ParseFailure)]
+		return run
+	report('Traceparent.from_string (invalid)', measure(reject(Traceparent.from_string, traceparents), number = 25000) * len(traceparents), 'headers/sec')
+	report('Traceparent.try_parse (invalid)', measure(try_reject(Traceparent.try_parse, traceparents), number = 25000) * len(traceparents), 'headers/sec')
+	report('Tracestate(header) (invalid)', measure(reject(Tracestate, tracestates), number = 25000) * len(tracestates), 'headers/sec')
+	report('Tracestate.try_parse (invalid)', measure(try_reject(Tracestate.try_parse, tracestates), number = 25000) * len(tracestates), 'headers/sec')
+
+def bench_harness():
+	'''
+	TestServer startup and shutdown time and CPU time used while idle, busy-poll monitor loop vs event loop thread
+	'''
+	# aiohttp is only needed by the harness benchmarks
+	import asyncio
+	from server import TestServer
+	class BusyPollTestServer(TestServer):
+		# the monitor loop as it was before the event loop got its own thread
+		def monitor(self):
+			while self.running:
+				self.loop.run_until_complete(asyncio.sleep(0.2))
+
+		def start(self):
+			self.running = True
+			self.thread = threading.Thread(target = self.monitor)
+			self.loop.run_until_complete(self.server.start())
+			self.thread.start()
+
+		def stop(self):
+			self.running = False
+			self.thread.join()
+			self.loop.run_until_complete(self.server.stop())
+			self.loop.close()
+	for cls in (BusyPollTestServer, TestServer):
+		startup = shutdown = 0
+		number = 10
+		for _ in range(number):
+			server = cls('127.0.0.1', 0)
+			start = time.perf_counter()
+			server.start()
+			startup += time.perf_counter() - start
+			start = time.perf_counter()
+			server.stop()
+			shutdown += time.perf_counter() - start
+		server = cls('127.0.0.1', 0)
+		server.start()
+		start = time.process_time()
+		time.sleep(1)
+		idle = time.process_time() - start
+		server.stop()
+		report('{} startup'.format(cls.__name__), startup / number * 1e6, 'usec')
+		report('{} shutdown'.format(cls.__name__), shutdown / number * 1e6, 'usec')
+		report('{} idle'.format(cls.__name__), idle * 1e6, 'usec cpu/sec')
+
+BENCHMARKS = {name[len('bench_'):]: func for name, func in globals().items() if name.startswith('bench_')}
+
+if __name__ == '__main__':
+	names = sys.argv[1:] or list(BENCHMARKS)
+	for name in names:
+		if name not in BENCHMARKS:
+			print('''
+Usage: python {0} [benchmarks]
+
+Available Benchmarks:
+{1}
+			'''.strip().format(sys.argv[0], '\n'.join('\t' + key for key in BENCHMARKS)), file = sys.stderr)
+			exit(-1)
+	for name in names:
+		print('{}: {}'.format(name, BENCHMARKS[name].__doc__.strip()))
+		BENCHMARKS[name]()
+		print()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
+from http.client import HTTPConnection
 import json
+import threading
 import uuid
 from urllib.error import HTTPError
-from urllib.request import HTTPHandler, OpenerDirector, Request
+from urllib.parse import urlsplit
 
 __all__ = ['TestClient']
 
@@ -12,18 +14,114 @@ class TestClient(object):
 		self.host = host
 		self.port = port
 		self.timeout = timeout
+		# keep-alive connections, one per thread and (host, port)
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		# the connections of all the threads, for close
+		self.connections = set()
+		self.connections_created = 0
+		self.requests_sent = 0
 
-	opener_director = OpenerDirector()
-	opener_director.add_handler(HTTPHandler())
+	def get_connection(self, netloc):
+		connections = getattr(self.local, 'connections', None)
+		if connections is None:
+			connections = self.local.connections = {}
+		connection = connections.get(netloc)
+		if connection is None:
+			connection = connections[netloc] = HTTPConnection(netloc, timeout = self.timeout)
+			with self.lock:
+				self.connections.add(connection)
+				self.connections_created += 1
+		return connection
 
-	def send_request(self, url, headers = {}, arguments = None):
+	def close_connection(self, netloc):
+		connection = self.local.connections.pop(netloc, None)
+		if connection:
+			with self.lock:
+				self.connections.discard(connection)
+			connection.close()
+
+	def close(self):
+		# closes the keep-alive connections of all the threads, which must not be sending requests anymore
+		with self.lock:
+			connections = self.connections
+			self.connections = set()
+		for connection in connections:
+			connection.close()
+
+	def connection_reuse_rate(self):
+		return 1 - self.connections_created / self.requests_sent if self.requests_sent else 0.0
+
+	def post(self, url, headers, arguments, check_status = True):
+		# returns the response once its headers arrived, the body is left for the caller to read
 		if not isinstance(arguments, bytes):
 			arguments = bytes(json.dumps(arguments), 'ascii')
-		request = Request(method = 'POST', url = url, headers = headers, data = arguments)
-		with self.opener_director.open(request, timeout = self.timeout) as response:
-			if response.status != 200:
-				raise HTTPError(url, response.status, response.msg, response.headers, None)
-			return json.loads(str(response.read(), 'ascii'))
+		parts = urlsplit(url)
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+		with self.lock:
+			self.requests_sent += 1
+		for attempt in range(2):
+			reused = parts.netloc in getattr(self.local, 'connections', {})
+			connection = self.get_connection(parts.netloc)
+			try:
+				connection.request('POST', path, body = arguments, headers = headers)
+				response = connection.getresponse()
+				break
+			except ConnectionError:
+				self.close_connection(parts.netloc)
+				# the server may have closed an idle keep-alive connection, retry once on a new one
+				if not reused or attempt:
+					raise
+			except Exception:
+				self.close_connection(parts.netloc)
+				raise
+		if check_status and response.status != 200:
+			self.close_connection(parts.netloc)
+			raise HTTPError(url, response.status, response.reason, response.headers, None)
+		return parts.netloc, response
+
+	def send_request(self, url, headers = {}, arguments = None):
+		netloc, response = self.post(url, headers, arguments)
+		try:
+			body = response.read()
+		except Exception:
+			self.close_connection(netloc)
+			raise
+		if response.will_close:
+			self.close_connection(netloc)
+		return json.loads(str(body, 'ascii'))
+
+	def send_and_discard(self, url, headers = {}, arguments = None):
+		'''
+		sends the request on a pooled connection and discards the response body, returns the status without checking it
+		'''
+		netloc, response = self.post(url, headers, arguments, check_status = False)
+		try:
+			response.read()
+		except Exception:
+			self.close_connection(netloc)
+			raise
+		if response.will_close:
+			self.close_connection(netloc)
+		return response.status
+
+	def stream_request(self, url, headers = {}, arguments = None):
+		'''
+		yields the records of an NDJSON response one by one as they arrive
+		'''
+		netloc, response = self.post(url, headers, arguments)
+		completed = False
+		try:
+			for line in response:
+				if line.strip():
+					yield json.loads(str(line, 'ascii'))
+			completed = True
+		finally:
+			# a partially read response leaves the connection unusable
+			if not completed or response.will_close:
+				self.close_connection(netloc)
 
 	class Scope(object):
 		def __init__(self, harness):
@@ -39,12 +137,36 @@ class TestClient(object):
 		def __repr__(self):
 			return '{}({})'.format(type(self).__name__, repr(self.id))
 
-		def send_request(self, arguments = None):
+		def request_url(self, concurrency = None, callbacks = None, stream = False):
+			# concurrency overrides how many of the actions in arguments the harness sends at the same time
+			# callbacks makes the harness wait (up to its timeout) until that many callbacks arrived for the scope
+			# stream makes the harness respond with NDJSON records instead of the whole scope
+			query = []
+			if concurrency is not None:
+				query.append('concurrency={}'.format(concurrency))
+			if callbacks is not None:
+				query.append('callbacks={}'.format(callbacks))
+			if stream:
+				query.append('stream=1')
+			query = '?' + '&'.join(query) if query else ''
+			return 'http://{}:{}/{}{}'.format(self.harness.host, self.harness.port, self.id, query)
+
+		def send_request(self, arguments = None, concurrency = None, callbacks = None):
 			return self.harness.send_request(
-				url = 'http://{}:{}/{}'.format(self.harness.host, self.harness.port, self.id),
+				url = self.request_url(concurrency, callbacks),
 				headers = {'Accept': 'application/json', 'Content-Type': 'application/json'},
 				arguments = arguments)
 
+		def stream_request(self, arguments = None, concurrency = None, callbacks = None):
+			'''
+			yields {'type': 'result', 'index': ...} records as the actions complete, then {'type': 'callback', 'id': ...}
+			records, arguments must not be empty
+			'''
+			return self.harness.stream_request(
+				url = self.request_url(concurrency, callbacks, stream = True),
+				headers = {'Accept': 'application/x-ndjson', 'Content-Type': 'application/json'},
+				arguments = arguments)
+
 		def url(self, path = ''):
 			return 'http://{}:{}/{}.{}'.format(self.harness.host, self.harness.port, self.id, path)
 
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import asyncio
+import math
+import os
+import sys
+import unittest
+import uuid
+from collections import Counter
+from server import AsyncTestServer
+from test import TestBase, TraceContextTest, environ, get_tracestate
+from tracecontext import Traceparent
+
+class CorpusRecorded(Exception):
+	pass
+
+class CorpusRecorder(TraceContextTest):
+	'''
+	collects the request headers of the TraceContextTest test cases instead of sending them
+	'''
+	corpus = None
+
+	def make_request(self, headers, count = 1):
+		self.corpus.append(headers)
+		raise CorpusRecorded()
+
+def load_corpus():
+	'''
+	returns the headers of the first request of every TraceContextTest test case which is enabled at the current levels
+	'''
+	corpus = []
+	CorpusRecorder.corpus = corpus
+	for name in unittest.TestLoader().getTestCaseNames(TraceContextTest):
+		try:
+			getattr(CorpusRecorder(name), name)()
+		except (CorpusRecorded, unittest.SkipTest):
+			pass
+	return corpus
+
+class LoadCase(object):
+	'''
+	one request of the corpus and what its callbacks are checked against
+	'''
+	def __init__(self, headers):
+		self.headers = headers
+		# only unambiguous input is expected to be propagated, anything else may restart the trace
+		self.traceparent = None
+		self.tracestate_keys = set()
+		values = [value for key, value in headers if TestBase.traceparent_name_re.match(key)]
+		if len(values) == 1:
+			try:
+				self.traceparent = Traceparent.from_string(values[0])
+			except ValueError:
+				pass
+		if self.traceparent:
+			try:
+				tracestate = get_tracestate(headers)
+				if tracestate.is_valid():
+					self.tracestate_keys = set(tracestate.keys())
+			except ValueError:
+				pass
+
+	def check(self, headers):
+		'''
+		returns the reason why the callback headers do not conform, None if they do
+		'''
+		values = [value for key, value in headers if TestBase.traceparent_name_re.match(key)]
+		if len(values) != 1:
+			return 'expect one traceparent header, got {}'.format(len(values))
+		try:
+			traceparent = Traceparent.from_string(values[0])
+		except ValueError:
+			return 'invalid traceparent'
+		try:
+			tracestate = get_tracestate(headers)
+		except ValueError:
+			return 'invalid tracestate'
+		if self.traceparent:
+			if traceparent.trace_id != self.traceparent.trace_id:
+				return 'trace_id not propagated'
+			if traceparent.parent_id == self.traceparent.parent_id:
+				return 'parent_id not updated'
+			# vendors may add their own member and truncate, but must not drop the whole tracestate
+			if self.tracestate_keys and not any(key in tracestate for key in self.tracestate_keys):
+				return 'tracestate not propagated'
+		return None
+
+class LoadGenerator(object):
+	'''
+	sends the corpus round robin to the service at a fixed rate, with at most concurrency requests in flight
+	'''
+	def __init__(self, server, endpoint, cases, rate, concurrency, duration, callback_host, callback_port):
+		self.server = server
+		self.endpoint = endpoint
+		self.cases = cases
+		self.rate = rate
+		self.concurrency = concurrency
+		self.duration = duration
+		self.callback_url = 'http://{}:{}/{{}}.0'.format(callback_host, callback_port)
+		self.latencies = []
+		self.errors = Counter()
+		self.elapsed = 0
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		semaphore = asyncio.Semaphore(self.concurrency)
+		tasks = []
+		start = loop.time()
+		for idx in range(max(int(self.rate * self.duration), 1)):
+			# latency counts from the scheduled time, so a service which falls behind is not hidden by the concurrency limit
+			scheduled = start + idx / self.rate
+			await asyncio.sleep(max(scheduled - loop.time(), 0))
+			await semaphore.acquire()
+			tasks.append(loop.create_task(self.send(self.cases[idx % len(self.cases)], scheduled, semaphore)))
+		await asyncio.gather(*tasks)
+		self.elapsed = loop.time() - start
+
+	async def send(self, case, scheduled, semaphore):
+		loop = asyncio.get_running_loop()
+		try:
+			scope_id = uuid.uuid4().hex
+			arguments = {
+				'url': self.endpoint,
+				'headers': case.headers,
+				'arguments': [{'url': self.callback_url.format(scope_id), 'arguments': []}],
+			}
+			scope = await self.server.run_scope(scope_id, arguments, callbacks = 1)
+			self.latencies.append(loop.time() - scheduled)
+			result = scope['results'][0]
+			if 'exception' in result:
+				error = result['exception']
+			elif result['status'] != 200:
+				error = 'HTTP status {}'.format(result['status'])
+			elif '0' not in scope:
+				error = 'missing callback'
+			else:
+				error = case.check(scope['0']['headers'])
+			if error:
+				self.errors[error] += 1
+		finally:
+			semaphore.release()
+
+	def percentile(self, fraction):
+		# nearest rank
+		latencies = sorted(self.latencies)
+		return latencies[max(math.ceil(fraction * len(latencies)) - 1, 0)]
+
+	def report(self):
+		count = len(self.latencies)
+		failed = sum(self.errors.values())
+		print('requests:               {}'.format(count))
+		print('throughput:             {:.1f} requests/sec (target {})'.format(count / self.elapsed, self.rate))
+		for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+			print('latency {:<15} {:.1f} ms'.format(name + ':', self.percentile(fraction) * 1000))
+		print('conformance error rate: {:.2%}'.format(failed / count))
+		for error, errors in self.errors.most_common():
+			print('\t{:>8} {}'.format(errors, error))
+		return failed
+
+async def run(endpoint, rate, concurrency, duration, host, port, bind_host, bind_port, timeout):
+	cases = [LoadCase(headers) for headers in load_corpus()]
+	server = AsyncTestServer(bind_host, bind_port, timeout, connection_limit = concurrency)
+	await server.start()
+	try:
+		generator = LoadGenerator(server, endpoint, cases, rate, concurrency, duration, host, port)
+		await generator.run()
+	finally:
+		await server.stop()
+	print('harness connection reuse rate: {:.0%}'.format(server.connection_reuse_rate()))
+	print('harness scopes: {} live, {} evicted, {} orphaned callbacks'.format(len(server.scopes), server.scopes.evicted, server.orphaned_callbacks))
+	return generator.report()
+
+if __name__ == '__main__':
+	if len(sys.argv) >= 2:
+		os.environ['SERVICE_ENDPOINT'] = sys.argv[1]
+	if not 'SERVICE_ENDPOINT' in os.environ:
+		print('''
+Usage: python {0} <service endpoint>
+
+Sends the request headers of TraceContextTest to your service at a fixed rate, checks the traceparent and tracestate
+of every callback and reports throughput, latency percentiles and the conformance error rate.
+
+Environment Variables:
+	HARNESS_HOST        the public host/address of the test harness (default 127.0.0.1)
+	HARNESS_PORT        the public port of the test harness (default 7777)
+	HARNESS_TIMEOUT     the timeout (in seconds) used for each request (default 5)
+	HARNESS_BIND_HOST   the host/address which the test harness binds to (default to HARNESS_HOST)
+	HARNESS_BIND_PORT   the port which the test harness binds to (default to HARNESS_PORT)
+	LOAD_RATE           the number of requests per second sent to your service (default 100)
+	LOAD_CONCURRENCY    the maximum number of requests in flight (default 10)
+	LOAD_DURATION       how long (in seconds) the load is sent (default 10)
+	SERVICE_ENDPOINT    your test service endpoint (no default value)
+	STRICT_LEVEL        the level of test strictness (default 2)
+	SPEC_LEVEL          the minimum version of the Trace Context specification being tested (default 1)
+
+Example:
+	python {0} http://127.0.0.1:5000/test
+	LOAD_RATE=500 LOAD_CONCURRENCY=50 python {0} http://127.0.0.1:5000/test
+		'''.strip().format(sys.argv[0]), file = sys.stderr)
+		exit(-1)
+
+	host = environ('HARNESS_HOST', '127.0.0.1')
+	port = environ('HARNESS_PORT', '7777')
+	failed = asyncio.run(run(
+		endpoint = environ('SERVICE_ENDPOINT'),
+		rate = float(environ('LOAD_RATE', '100')),
+		concurrency = int(environ('LOAD_CONCURRENCY', '10')),
+		duration = float(environ('LOAD_DURATION', '10')),
+		host = host,
+		port = int(port),
+		bind_host = environ('HARNESS_BIND_HOST', host),
+		bind_port = int(environ('HARNESS_BIND_PORT', port)),
+		timeout = int(environ('HARNESS_TIMEOUT', '5')),
+	))
+	sys.exit(1 if failed else 0)
@@ -1,10 +1,41 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import json
+from client import TestClient
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
 from tracecontext import BaseTraceparent, Traceparent, Tracestate
 from urllib.request import HTTPHandler, OpenerDirector, Request
 
-test_data = []
+class TestDataRecorder(object):
+	'''
+	keeps the last max_records records in memory and, once open is called, appends every record to a JSON Lines file
+	'''
+	def __init__(self, max_records = 1000):
+		self.lock = Lock()
+		self.records = deque(maxlen = max_records)
+		self.file = None
+
+	def open(self, path):
+		with self.lock:
+			# line buffered, so every record reaches the file as it arrives
+			self.file = open(path, 'w', buffering = 1)
+
+	def close(self):
+		with self.lock:
+			if self.file:
+				self.file.close()
+				self.file = None
+
+	def record(self, record):
+		line = json.dumps(record) + '\n'
+		with self.lock:
+			self.records.append(record)
+			if self.file:
+				self.file.write(line)
+
+test_data = TestDataRecorder()
 
 class DemoServer(HTTPServer):
 	def __init__(self, host = '127.0.0.1', port = None, timeout = 5):
@@ -16,7 +47,7 @@ class DemoServer(HTTPServer):
 			self.port = 5000
 		while self.port < 65535:
 			try:
-				super().__init__((self.host, self.port), DemoServer.RequestHandler)
+				super().__init__((self.host, self.port), self.RequestHandler)
 				break
 			except OSError as err:
 				if port:
@@ -39,24 +70,34 @@ class DemoServer(HTTPServer):
 	def stop(self):
 		self.shutdown()
 		self.worker_thread.join()
+		self.server_close()
+
+	def send_callbacks(self, callbacks):
+		# (url, headers, arguments) tuples, sent one after another
+		for url, headers, arguments in callbacks:
+			request = Request(method = 'POST', url = url, headers = headers, data = bytes(json.dumps(arguments), 'ascii'))
+			with self.opener_director.open(request, timeout = self.timeout) as response:
+				pass
+
+	opener_director = OpenerDirector()
+	opener_director.add_handler(HTTPHandler())
 
 	class RequestHandler(BaseHTTPRequestHandler):
-		opener_director = OpenerDirector()
-		opener_director.add_handler(HTTPHandler())
 		server_version = 'DemoServer/0.1'
+		# budgets for the combined tracestate headers, anything larger is treated as malformed without being parsed
+		tracestate_max_bytes = 8192
+		tracestate_max_members = 128
 
 		def do_POST(self):
-			global test_data
-
 			self.send_response(200)
 			arguments = json.loads(str(self.rfile.read(int(self.headers['Content-Length'])), 'ascii'))
 
 			traceparent = None
 			tracestate = Tracestate()
 
-			test_data.append({
+			record = {
 				'headers': self.get_headers('traceparent') + self.get_headers('tracestate'),
-			})
+			}
 
 			try:
 				temp_traceparent = BaseTraceparent.from_string(self.get_header('traceparent'))
@@ -64,34 +105,37 @@ class DemoServer(HTTPServer):
 					if temp_traceparent._residue:
 						raise ValueError('illegal traceparent format')
 				traceparent = Traceparent(0, temp_traceparent.trace_id, temp_traceparent.parent_id, temp_traceparent.trace_flags)
-				test_data[-1]['is_traceparent_valid'] = True
+				record['is_traceparent_valid'] = True
 			except ValueError:
-				test_data[-1]['is_traceparent_valid'] = False
+				record['is_traceparent_valid'] = False
 
 			try:
-				header = self.get_header('tracestate', commaSeparated = True)
+				header = self.get_header('tracestate', commaSeparated = True, max_bytes = self.tracestate_max_bytes)
 				if header:
-					tracestate = Tracestate(header)
-					if test_data[-1]['is_traceparent_valid']:
-						test_data[-1]['is_tracestate_valid'] = True
+					tracestate = Tracestate().from_string(header, max_members = self.tracestate_max_members)
+					if record['is_traceparent_valid']:
+						record['is_tracestate_valid'] = True
 			except ValueError:
 				# if tracestate is malformed, reuse the traceparent instead of restart the trace
 				# traceparent = Traceparent()
-				test_data[-1]['is_tracestate_valid'] = False
+				record['is_tracestate_valid'] = False
+
+			test_data.record(record)
 
 			if traceparent is None:
 				# if traceparent is malformed, discard tracestate
 				traceparent = Traceparent()
 				tracestate = Tracestate()
 
+			callbacks = []
 			for item in arguments:
 				headers = {}
-				headers['traceparent'] = str(Traceparent(0, traceparent.trace_id, None, traceparent.trace_flags))
+				headers['traceparent'] = str(traceparent.child())
 				if tracestate.is_valid():
 					headers['tracestate'] = str(tracestate)
-				request = Request(method = 'POST', url = item['url'], headers = headers, data = bytes(json.dumps(item['arguments']), 'ascii'))
-				with self.opener_director.open(request, timeout = self.timeout) as response:
-					pass
+				callbacks.append((item['url'], headers, item['arguments']))
+			self.server.send_callbacks(callbacks)
+			self.send_header('Content-Length', '0')
 			self.end_headers()
 
 		def get_headers(self, name):
@@ -99,7 +143,7 @@ class DemoServer(HTTPServer):
 			headers = filter(lambda kv: kv[0].lower() == name, self.headers.items())
 			return tuple(headers)
 
-		def get_header(self, name, commaSeparated = False):
+		def get_header(self, name, commaSeparated = False, max_bytes = None):
 			headers = self.get_headers(name)
 			# https://httpwg.org/specs/rfc9110.html#fields.values
 			# remove the leading whitespace and trailing whitespace
@@ -109,6 +153,8 @@ class DemoServer(HTTPServer):
 			if not headers:
 				return None
 			if commaSeparated:
+				if max_bytes is not None and sum(map(len, headers)) + len(headers) - 1 > max_bytes:
+					raise ValueError('header {} exceeds {} bytes'.format(name, max_bytes))
 				return ','.join(headers)
 			if len(headers) == 1:
 				return headers[0]
@@ -117,14 +163,44 @@ class DemoServer(HTTPServer):
 		def log_message(self, format, *args):
 			pass
 
+class ThreadingDemoServer(ThreadingMixIn, DemoServer):
+	'''
+	handles every request on its own thread and sends the callbacks of a request concurrently over kept alive connections
+	'''
+	daemon_threads = True
+
+	def __init__(self, host = '127.0.0.1', port = None, timeout = 5, max_workers = 32):
+		self.executor = ThreadPoolExecutor(max_workers)
+		# only used for its per thread connection pool
+		self.client = TestClient(host = None, port = None, timeout = timeout)
+		super().__init__(host, port, timeout)
+
+	def stop(self):
+		super().stop()
+		self.executor.shutdown()
+		self.client.close()
+
+	def send_callbacks(self, callbacks):
+		# like DemoServer, the status and body of the response to a callback are ignored (e.g. 404 for a late callback)
+		futures = [self.executor.submit(self.client.send_and_discard, url, headers, arguments) for url, headers, arguments in callbacks]
+		for future in futures:
+			future.result()
+
+	class RequestHandler(DemoServer.RequestHandler):
+		# keeps the connections from the harness alive
+		protocol_version = 'HTTP/1.1'
+
 if __name__ == '__main__':
 	import os
 	import subprocess
 	import sys
-	with DemoServer() as server:
+	# SELF_TEST_THREADING runs the self test against ThreadingDemoServer
+	server_class = ThreadingDemoServer if 'SELF_TEST_THREADING' in os.environ else DemoServer
+	with server_class() as server:
 		os.environ['SERVICE_ENDPOINT'] = 'http://{}:{}/'.format(server.host, server.port)
-		errno = subprocess.call(['python', '-m', 'unittest', '-v'] + sys.argv[1:])
-		ofile = open("test_data.json", "w")
-		ofile.write('[\n' + ',\n'.join(map(lambda x: '\t' + json.dumps(x), test_data)) + '\n' + ']' + '\n')
-		ofile.close()
+		test_data.open('test_data.jsonl')
+		try:
+			errno = subprocess.call(['python', '-m', 'unittest', '-v'] + sys.argv[1:])
+		finally:
+			test_data.close()
 		sys.exit(errno)
@@ -1,19 +1,125 @@
-from aiohttp import ClientSession, ClientTimeout, ContentTypeError, web
+import asyncio
+from collections import OrderedDict
+import json
+import time
+from aiohttp import ClientSession, ClientTimeout, ContentTypeError, TCPConnector, TraceConfig, web
 from multidict import MultiDict
 
-class AsyncTestServer(object):
-	scopes = {}
+class CallbackWaiter(object):
+	'''
+	completes once the expected number of callbacks arrived for a scope
+	'''
+	def __init__(self, expected):
+		self.expected = expected
+		self.received = 0
+		self.event = asyncio.Event()
+		if expected <= 0:
+			self.event.set()
+
+	def notify(self):
+		self.received += 1
+		if self.received >= self.expected:
+			self.event.set()
+
+	async def wait(self, timeout):
+		try:
+			await asyncio.wait_for(self.event.wait(), max(timeout, 0))
+		except asyncio.TimeoutError:
+			pass
+		return self.event.is_set()
+
+class ScopeRegistry(object):
+	'''
+	scopes and their callback waiters by scope id, which expire ttl seconds after they were added,
+	the oldest ones are evicted early once there are more than max_scopes
+	'''
+	def __init__(self, ttl = 60, max_scopes = 10000, clock = time.monotonic):
+		self.ttl = ttl
+		self.max_scopes = max_scopes
+		self.clock = clock
+		# scope id -> (expiry, scope, waiter), the ttl is the same for all so the first entry always expires first
+		self.entries = OrderedDict()
+		self.evicted = 0
+
+	def __contains__(self, scope_id):
+		self.expire()
+		return scope_id in self.entries
+
+	def __len__(self):
+		self.expire()
+		return len(self.entries)
+
+	def add(self, scope_id, scope, waiter = None):
+		self.expire()
+		self.entries.pop(scope_id, None)
+		self.entries[scope_id] = (self.clock() + self.ttl, scope, waiter)
+		while len(self.entries) > self.max_scopes:
+			self.evict(next(iter(self.entries)))
 
-	def __init__(self, host, port, timeout = 5):
+	def get(self, scope_id):
+		# returns (scope, waiter), or (None, None) if there is no such scope (anymore)
+		self.expire()
+		entry = self.entries.get(scope_id)
+		return (entry[1], entry[2]) if entry else (None, None)
+
+	def refresh(self, scope_id):
+		# restarts the ttl of a scope which is still making progress, keeps the entries ordered by expiry
+		entry = self.entries.pop(scope_id, None)
+		if entry:
+			self.entries[scope_id] = (self.clock() + self.ttl, entry[1], entry[2])
+
+	def remove(self, scope_id):
+		self.entries.pop(scope_id, None)
+
+	def expire(self):
+		entries = self.entries
+		now = self.clock()
+		while entries:
+			scope_id = next(iter(entries))
+			if entries[scope_id][0] > now:
+				break
+			self.evict(scope_id)
+
+	def evict(self, scope_id):
+		expiry, scope, waiter = self.entries.pop(scope_id)
+		self.evicted += 1
+		if waiter:
+			# the originating request stops waiting and responds with the callbacks which arrived so far
+			waiter.event.set()
+
+class AsyncTestServer(object):
+	def __init__(self, host, port, timeout = 5, connection_limit = 100, connection_limit_per_host = 0, action_concurrency = 1, scope_ttl = 60, max_scopes = 10000):
 		self.host = host
 		self.port = port
 		self.timeout = ClientTimeout(total = timeout)
+		# how many actions of one scope request are sent at the same time, 1 sends them one after another
+		self.action_concurrency = action_concurrency
+		self.connection_limit = connection_limit
+		self.connection_limit_per_host = connection_limit_per_host
+		self.session = None
+		# each action and the wait for callbacks take at most timeout and the ttl restarts whenever an action completes,
+		# so a scope whose request is still running never expires
+		self.scopes = ScopeRegistry(max(scope_ttl, 2 * timeout), max_scopes)
+		# callbacks for scopes which already completed, expired or never existed
+		self.orphaned_callbacks = 0
+		self.connections_created = 0
+		self.connections_reused = 0
 		self.app = web.Application()
 		self.app.add_routes([
 			web.post('/{scope}', self.scope_handler),
 		])
 
 	async def start(self):
+		# one pooled session for all the requests to the services under test, so connections are kept alive
+		trace_config = TraceConfig()
+		trace_config.on_connection_create_end.append(self.on_connection_create_end)
+		trace_config.on_connection_reuseconn.append(self.on_connection_reuseconn)
+		self.session = ClientSession(
+			connector = TCPConnector(limit = self.connection_limit, limit_per_host = self.connection_limit_per_host),
+			headers = [['Accept', 'application/json']],
+			timeout = self.timeout,
+			trace_configs = [trace_config],
+		)
 		self.runner = web.AppRunner(self.app)
 		await self.runner.setup()
 		self.site = web.TCPSite(self.runner, self.host, self.port)
@@ -22,78 +128,180 @@ class AsyncTestServer(object):
 
 	async def stop(self):
 		await self.runner.cleanup()
+		await self.session.close()
+
+	async def on_connection_create_end(self, session, context, params):
+		self.connections_created += 1
+
+	async def on_connection_reuseconn(self, session, context, params):
+		self.connections_reused += 1
+
+	def connection_reuse_rate(self):
+		total = self.connections_created + self.connections_reused
+		return self.connections_reused / total if total else 0.0
 
 	async def scope_handler(self, request):
 		scope_id = request.match_info['scope'].split('.', maxsplit = 1)
 		callback_id = None if len(scope_id) == 1 else scope_id[1]
 		scope_id = scope_id[0]
 		arguments = await request.json()
-		scope = None
-		if callback_id:
-			scope = self.scopes[scope_id]
-			scope[callback_id] = {
-				'headers': list(request.headers.items()),
-				'arguments': arguments,
-			}
-		else:
-			scope = {
-				'headers': list(request.headers.items()),
-				'arguments': arguments,
-				'results': [],
-			}
-			self.scopes[scope_id] = scope
+		concurrency = int(request.query['concurrency']) if 'concurrency' in request.query else None
+		if not callback_id:
+			# the number of callbacks the scope request expects, services may make them after they responded
+			callbacks = int(request.query['callbacks']) if 'callbacks' in request.query else None
+			if 'stream' in request.query and arguments:
+				return await self.stream_scope(request, scope_id, arguments, callbacks, concurrency)
+			scope = await self.run_scope(scope_id, arguments, request.headers.items(), callbacks, concurrency)
+			return web.json_response(scope if arguments else None)
+		scope, waiter = self.scopes.get(scope_id)
+		if scope is None:
+			self.orphaned_callbacks += 1
+			return web.json_response(None, status = 404)
+		scope[callback_id] = {
+			'headers': list(request.headers.items()),
+			'arguments': arguments,
+		}
+		if waiter:
+			waiter.notify()
 		if not arguments:
 			return web.json_response(None)
+		await self.run_actions(scope, arguments, concurrency)
+		return web.json_response(scope)
+
+	async def stream_scope(self, request, scope_id, arguments, callbacks, concurrency):
+		'''
+		responds with NDJSON instead of the whole scope, one line per action result as soon as the action completes,
+		then one line per callback, the request headers and arguments are not echoed
+		'''
+		response = web.StreamResponse(headers = {'Content-Type': 'application/x-ndjson'})
+		await response.prepare(request)
+		closed = False
+		async def write(record):
+			nonlocal closed
+			# the client may stop reading early, the scope still completes so its callbacks are not orphaned
+			if closed:
+				return
+			try:
+				await response.write(bytes(json.dumps(record), 'ascii') + b'\n')
+			except ConnectionResetError:
+				closed = True
+		async def on_result(idx, result):
+			await write(dict(result, type = 'result', index = idx))
+		scope = await self.run_scope(scope_id, arguments, (), callbacks, concurrency, on_result)
+		for key, value in scope.items():
+			if key not in ('headers', 'arguments', 'results'):
+				await write(dict(value, type = 'callback', id = key))
+		if not closed:
+			await response.write_eof()
+		return response
+
+	async def run_scope(self, scope_id, arguments, headers = (), callbacks = None, concurrency = None, on_result = None):
+		'''
+		runs the actions of a scope and waits for the expected number of callbacks, returns the scope
+		'''
+		deadline = asyncio.get_running_loop().time() + self.timeout.total
+		waiter = None
+		if callbacks is not None and arguments:
+			waiter = CallbackWaiter(callbacks)
+		scope = {
+			'headers': list(headers),
+			'arguments': arguments,
+			'results': [],
+		}
+		self.scopes.add(scope_id, scope, waiter)
+		async def on_progress(idx, result):
+			self.scopes.refresh(scope_id)
+			if on_result:
+				await on_result(idx, result)
+		try:
+			if arguments:
+				await self.run_actions(scope, arguments, concurrency, on_progress)
+			if waiter:
+				await waiter.wait(deadline - asyncio.get_running_loop().time())
+		finally:
+			self.scopes.remove(scope_id)
+		return scope
+
+	async def run_actions(self, scope, arguments, concurrency = None, on_result = None):
+		# on_result(index, result) is awaited as soon as an action completes, index is the position in scope['results']
 		if not isinstance(arguments, list):
 			arguments = [arguments]
-		for action in arguments:
-			headers = [['Accept', 'application/json']]
-			if 'headers' in action:
-				headers += action['headers']
-			async with ClientSession(headers = headers, timeout = self.timeout) as session:
-				arguments = []
-				if 'arguments' in action:
-					arguments = action['arguments'] or []
-				result = {}
-				result['url'] = action['url']
-				scope['results'].append(result)
-				try:
-					async with session.post(action['url'], json = arguments) as response:
-						result['status'] = response.status
-						result['headers'] = list(response.headers.items())
-						result['body'] = await response.json(content_type = 'application/json')
-				except ContentTypeError as err:
-						result['body'] = await response.text()
-				except Exception as err:
-					result['exception'] = type(err).__name__
-					result['msg'] = str(err)
-		if not callback_id:
-			del self.scopes[scope_id]
-		return web.json_response(scope)
+		# results keep the order of the actions, whichever completes first
+		offset = len(scope['results'])
+		results = [{'url': action['url']} for action in arguments]
+		scope['results'].extend(results)
+		if concurrency is None:
+			concurrency = self.action_concurrency
+		if concurrency > 1 and len(arguments) > 1:
+			semaphore = asyncio.Semaphore(concurrency)
+			async def run_action(idx, action, result):
+				async with semaphore:
+					await self.run_action(action, result)
+				if on_result:
+					await on_result(offset + idx, result)
+			await asyncio.gather(*map(run_action, range(len(arguments)), arguments, results))
+		else:
+			for idx, (action, result) in enumerate(zip(arguments, results)):
+				await self.run_action(action, result)
+				if on_result:
+					await on_result(offset + idx, result)
+
+	async def run_action(self, action, result):
+		headers = []
+		if 'headers' in action:
+			headers += action['headers']
+		arguments = []
+		if 'arguments' in action:
+			arguments = action['arguments'] or []
+		try:
+			async with self.session.post(action['url'], headers = headers, json = arguments) as response:
+				result['status'] = response.status
+				result['headers'] = list(response.headers.items())
+				result['body'] = await response.json(content_type = 'application/json')
+		except ContentTypeError as err:
+				result['body'] = await response.text()
+		except Exception as err:
+			result['exception'] = type(err).__name__
+			result['msg'] = str(err)
 
 class TestServer(object):
-	def __init__(self, host, port, timeout = 5):
-		import asyncio
+	'''
+	runs an AsyncTestServer on an event loop in its own thread
+	'''
+	def __init__(self, host, port, timeout = 5, **kwds):
 		from threading import Thread
 		self.loop = asyncio.new_event_loop()
-		asyncio.set_event_loop(self.loop)
-		self.server = AsyncTestServer(host, port, timeout)
-		self.thread = Thread(target = self.monitor)
-		self.run = True
+		self.server = AsyncTestServer(host, port, timeout, **kwds)
+		self.thread = Thread(target = self.loop.run_forever)
 
-	def monitor(self):
-		import asyncio
-		while self.run:
-			self.loop.run_until_complete(asyncio.sleep(0.2))
+	def call(self, coro):
+		# runs a coroutine on the event loop thread and waits for its result
+		return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
 
 	def start(self):
-		self.loop.run_until_complete(self.server.start())
 		self.thread.start()
+		try:
+			self.call(self.server.start())
+		except BaseException:
+			# otherwise the loop thread keeps the process alive, e.g. if the port is in use
+			self.stop_loop()
+			raise
 
 	def stop(self):
-		self.run = False
+		if not self.thread.is_alive():
+			# never started, or start failed and already stopped the loop, nothing would run the coroutine
+			if not self.loop.is_closed():
+				self.loop.close()
+			return
+		try:
+			self.call(self.server.stop())
+		finally:
+			self.stop_loop()
+
+	def stop_loop(self):
+		self.loop.call_soon_threadsafe(self.loop.stop)
 		self.thread.join()
-		self.loop.run_until_complete(self.server.stop())
+		self.loop.close()
 
 	def __enter__(self):
 		self.start()
@@ -26,6 +26,18 @@ SPEC_LEVEL = int(environ('SPEC_LEVEL', DEFAULT_SPEC_LEVEL))
 print('STRICT_LEVEL: {}'.format(STRICT_LEVEL))
 print('SPEC_LEVEL:   {}'.format(SPEC_LEVEL))
 
+def get_tracestate(headers, max_bytes = None):
+	'''
+	combines the tracestate headers, raises ValueError as soon as they exceed max_bytes (default TestBase.tracestate_max_bytes)
+	'''
+	tracestate = Tracestate()
+	budget = TestBase.tracestate_max_bytes if max_bytes is None else max_bytes
+	for key, value in headers:
+		if TestBase.tracestate_name_re.match(key):
+			tracestate.from_string(value, max_bytes = budget)
+			budget -= len(value)
+	return tracestate
+
 def setUpModule():
 	global client
 	global server
@@ -37,6 +49,7 @@ def setUpModule():
 		response = scope.send_request()
 
 def tearDownModule():
+	client.close()
 	server.stop()
 
 class TestBase(unittest.TestCase):
@@ -45,6 +58,9 @@ class TestBase(unittest.TestCase):
 	traceparent_format = r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$'
 	traceparent_format_re = re.compile(traceparent_format)
 	tracestate_name_re = re.compile(r'^tracestate$', re.IGNORECASE)
+	# upper bound of all the tracestate headers of one callback combined, far above the 512 bytes of the specification,
+	# so a misbehaving service cannot make the harness parse or join megabytes
+	tracestate_max_bytes = 8192
 
 	def make_request(self, headers, count = 1):
 		import pprint
@@ -56,7 +72,7 @@ class TestBase(unittest.TestCase):
 			}
 			for idx in range(count):
 				arguments['arguments'].append({'url': scope.url(str(idx)), 'arguments': []})
-			response = scope.send_request(arguments = arguments)
+			response = scope.send_request(arguments = arguments, callbacks = count)
 			verbose = ['', '']
 			verbose.append('Harness trying to send the following request to your service {0}'.format(arguments['url']))
 			verbose.append('')
@@ -88,6 +104,7 @@ class TestBase(unittest.TestCase):
 					for key, value in response[str(idx)]['headers']:
 						verbose.append('{}: {}'.format(key, value))
 					verbose.append('')
+			verbose.append('Harness connection reuse rate: client {:.0%}, server {:.0%}'.format(client.connection_reuse_rate(), server.server.connection_reuse_rate()))
 			verbose.append('')
 			verbose = os.linesep.join(verbose)
 			if 'HARNESS_DEBUG' in os.environ:
@@ -107,11 +124,7 @@ class TestBase(unittest.TestCase):
 		return Traceparent.from_string(retval[0][1])
 
 	def get_tracestate(self, headers):
-		tracestate = Tracestate()
-		for key, value in headers:
-			if self.tracestate_name_re.match(key):
-				tracestate.from_string(value)
-		return tracestate
+		return get_tracestate(headers, self.tracestate_max_bytes)
 
 	def make_single_request_and_get_tracecontext(self, headers):
 		headers = self.make_request(headers)[0]['headers']
@@ -927,6 +940,90 @@ class TraceContext2Test(TestBase):
 		self.assertNotEqual(traceparent.parent_id.hex(), '1234567890123456')
 		self.assert_bit_set(traceparent.trace_flags, 2, "random flag not set")
 
+class RecordingTestResult(unittest.TestResult):
+	'''
+	records the outcome of a single test case, so that it can be replayed into the reporting result later
+	'''
+	def __init__(self):
+		super().__init__()
+		self.events = []
+
+	def replay(self, result):
+		for name, args in self.events:
+			method = getattr(result, name, None)
+			if method:
+				method(*args)
+
+	def startTest(self, test):
+		self.events.append(('startTest', (test,)))
+
+	def stopTest(self, test):
+		self.events.append(('stopTest', (test,)))
+
+	def addSuccess(self, test):
+		self.events.append(('addSuccess', (test,)))
+
+	def addError(self, test, err):
+		self.events.append(('addError', (test, err)))
+
+	def addFailure(self, test, err):
+		self.events.append(('addFailure', (test, err)))
+
+	def addSkip(self, test, reason):
+		self.events.append(('addSkip', (test, reason)))
+
+	def addExpectedFailure(self, test, err):
+		self.events.append(('addExpectedFailure', (test, err)))
+
+	def addUnexpectedSuccess(self, test):
+		self.events.append(('addUnexpectedSuccess', (test,)))
+
+	def addSubTest(self, test, subtest, err):
+		self.events.append(('addSubTest', (test, subtest, err)))
+
+	def addDuration(self, test, elapsed):
+		self.events.append(('addDuration', (test, elapsed)))
+
+class ConcurrentTestRunner(unittest.TextTestRunner):
+	'''
+	runs the test cases on a thread pool against the shared harness server, the scope ids keep them apart,
+	results are reported in the order of the suite once every test case completed
+	'''
+	def __init__(self, concurrency, **kwds):
+		super().__init__(**kwds)
+		self.concurrency = concurrency
+
+	def run(self, test):
+		return super().run(lambda result: self.run_concurrently(test, result))
+
+	def run_concurrently(self, suite, result):
+		from concurrent.futures import ThreadPoolExecutor
+		def flatten(suite):
+			for test in suite:
+				if isinstance(test, unittest.TestSuite):
+					yield from flatten(test)
+				else:
+					yield test
+		def run_one(test):
+			recorder = RecordingTestResult()
+			test(recorder)
+			return recorder
+		tests = list(flatten(suite))
+		try:
+			setUpModule()
+		except Exception:
+			# reported like unittest reports a failing setUpModule, none of the test cases run
+			from unittest.suite import _ErrorHolder
+			result.addError(_ErrorHolder('setUpModule ({})'.format(__name__)), sys.exc_info())
+			return
+		try:
+			with ThreadPoolExecutor(max_workers = self.concurrency) as executor:
+				recorders = list(executor.map(run_one, tests))
+		finally:
+			tearDownModule()
+		for recorder in recorders:
+			recorder.replay(result)
+
 if __name__ == '__main__':
 	if len(sys.argv) >= 2:
 		os.environ['SERVICE_ENDPOINT'] = sys.argv[1]
@@ -935,15 +1032,17 @@ if __name__ == '__main__':
 Usage: python {0} <service endpoint> [patterns]
 
 Environment Variables:
-	HARNESS_DEBUG      when set, debug mode will be enabled (default to disabled)
-	HARNESS_HOST       the public host/address of the test harness (default 127.0.0.1)
-	HARNESS_PORT       the public port of the test harness (default 7777)
-	HARNESS_TIMEOUT    the timeout (in seconds) used for each test case (default 5)
-	HARNESS_BIND_HOST  the host/address which the test harness binds to (default to HARNESS_HOST)
-	HARNESS_BIND_PORT  the port which the test harness binds to (default to HARNESS_PORT)
-	SERVICE_ENDPOINT   your test service endpoint (no default value)
-	STRICT_LEVEL       the level of test strictness (default 2)
-	SPEC_LEVEL         the minimum version of the Trace Context specification being tested (default 1)
+	HARNESS_DEBUG       when set, debug mode will be enabled (default to disabled)
+	HARNESS_HOST        the public host/address of the test harness (default 127.0.0.1)
+	HARNESS_PORT        the public port of the test harness (default 7777)
+	HARNESS_TIMEOUT     the timeout (in seconds) used for each test case (default 5)
+	HARNESS_BIND_HOST   the host/address which the test harness binds to (default to HARNESS_HOST)
+	HARNESS_BIND_PORT   the port which the test harness binds to (default to HARNESS_PORT)
+	HARNESS_CONCURRENCY the number of test cases which run at the same time (default 1)
+	HARNESS_FANOUT      the number of actions of one request which the harness sends at the same time (default 1)
+	SERVICE_ENDPOINT    your test service endpoint (no default value)
+	STRICT_LEVEL        the level of test strictness (default 2)
+	SPEC_LEVEL          the minimum version of the Trace Context specification being tested (default 1)
 
 Example:
 	# Run all tests
@@ -978,7 +1077,8 @@ Available Test Suites:
 	bind_host = environ('HARNESS_BIND_HOST', host)
 	bind_port = environ('HARNESS_BIND_PORT', port)
 	client = TestClient(host = host, port = int(port), timeout = int(timeout) + 1)
-	server = TestServer(host = bind_host, port = int(bind_port), timeout = int(timeout))
+	fanout = environ('HARNESS_FANOUT', '1')
+	server = TestServer(host = bind_host, port = int(bind_port), timeout = int(timeout), action_concurrency = int(fanout))
 
 	suite = unittest.TestSuite()
 	loader = unittest.TestLoader()
@@ -987,5 +1087,9 @@ Available Test Suites:
 			suite.addTests(loader.loadTestsFromName(name, module = sys.modules[__name__]))
 	else:
 		suite.addTests(loader.loadTestsFromModule(sys.modules[__name__]))
-	result = unittest.TextTestRunner(verbosity = 2).run(suite)
+	concurrency = int(environ('HARNESS_CONCURRENCY', '1'))
+	if concurrency > 1:
+		result = ConcurrentTestRunner(concurrency, verbosity = 2).run(suite)
+	else:
+		result = unittest.TextTestRunner(verbosity = 2).run(suite)
 	sys.exit(len(result.errors) + len(result.failures))
@@ -0,0 +1,178 @@
+import io
+import os
+import socket
+import unittest
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import server
+import client
+
+def free_port():
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+class FakeClock(object):
+	def __init__(self):
+		self.now = 0
+
+	def __call__(self):
+		return self.now
+
+class ScopeRegistryTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+		self.scopes = server.ScopeRegistry(ttl = 10, max_scopes = 3, clock = self.clock)
+
+	def test_expire(self):
+		self.scopes.add('a', {'id': 'a'})
+		self.clock.now = 5
+		self.scopes.add('b', {'id': 'b'})
+		self.assertEqual(self.scopes.get('a'), ({'id': 'a'}, None))
+		self.clock.now = 10
+		self.assertEqual(self.scopes.get('a'), (None, None))
+		self.assertTrue('b' in self.scopes)
+		self.clock.now = 15
+		self.assertEqual(len(self.scopes), 0)
+		self.assertEqual(self.scopes.evicted, 2)
+
+	def test_refresh(self):
+		self.scopes.add('a', {})
+		self.scopes.add('b', {})
+		self.clock.now = 8
+		self.scopes.refresh('a')
+		self.scopes.refresh('unknown')
+		self.clock.now = 12
+		self.assertTrue('a' in self.scopes)
+		self.assertFalse('b' in self.scopes)
+		self.clock.now = 18
+		self.assertFalse('a' in self.scopes)
+
+	def test_max_scopes(self):
+		waiters = [server.CallbackWaiter(1) for _ in range(4)]
+		for idx, waiter in enumerate(waiters):
+			self.scopes.add(str(idx), {}, waiter)
+		# the oldest scope is evicted and its request stops waiting for callbacks
+		self.assertEqual(len(self.scopes), 3)
+		self.assertFalse('0' in self.scopes)
+		self.assertEqual(self.scopes.evicted, 1)
+		self.assertTrue(waiters[0].event.is_set())
+		self.assertFalse(any(waiter.event.is_set() for waiter in waiters[1:]))
+		# removing a completed scope does not count as an eviction
+		self.scopes.remove('1')
+		self.assertEqual(len(self.scopes), 2)
+		self.assertEqual(self.scopes.evicted, 1)
+
+	def test_expire_releases_waiter(self):
+		waiter = server.CallbackWaiter(2)
+		self.scopes.add('a', {}, waiter)
+		waiter.notify()
+		self.assertFalse(waiter.event.is_set())
+		self.clock.now = 10
+		self.scopes.expire()
+		self.assertTrue(waiter.event.is_set())
+
+	def test_ttl_covers_timeout(self):
+		harness = server.AsyncTestServer('127.0.0.1', 0, timeout = 100, scope_ttl = 60)
+		self.assertEqual(harness.scopes.ttl, 200)
+
+class TestServerTest(unittest.TestCase):
+	def test_stop_without_start(self):
+		harness = server.TestServer('127.0.0.1', 0)
+		harness.stop()
+		self.assertTrue(harness.loop.is_closed())
+
+	def test_start_stop(self):
+		with server.TestServer('127.0.0.1', 0) as harness:
+			self.assertTrue(harness.thread.is_alive())
+		self.assertFalse(harness.thread.is_alive())
+		# a second stop does nothing
+		harness.stop()
+
+	def test_orphaned_callback(self):
+		port = free_port()
+		with server.TestServer('127.0.0.1', port) as harness:
+			request = Request('http://127.0.0.1:{}/unknown.0'.format(port), method = 'POST', data = b'[]', headers = {'Content-Type': 'application/json'})
+			with self.assertRaises(HTTPError) as context:
+				urlopen(request, timeout = 5)
+			self.assertEqual(context.exception.code, 404)
+			context.exception.close()
+			self.assertEqual(harness.server.orphaned_callbacks, 1)
+
+class StreamTest(unittest.TestCase):
+	def setUp(self):
+		port = free_port()
+		self.harness = server.TestServer('127.0.0.1', port)
+		self.harness.start()
+		self.addCleanup(self.harness.stop)
+		self.client = client.TestClient('127.0.0.1', port)
+		self.addCleanup(self.client.close)
+
+	def fan_out(self, scope, count):
+		# the actions call back the scope itself, so no service is needed
+		return [{'url': scope.url(str(idx)), 'arguments': []} for idx in range(count)]
+
+	def test_stream(self):
+		for _ in range(2):
+			with self.client.scope() as scope:
+				records = list(scope.stream_request(self.fan_out(scope, 3), concurrency = 3, callbacks = 3))
+			self.assertEqual([record['type'] for record in records], ['result'] * 3 + ['callback'] * 3)
+			results = records[:3]
+			self.assertEqual(sorted(record['index'] for record in results), [0, 1, 2])
+			for record in results:
+				self.assertEqual(record['status'], 200)
+				self.assertEqual(record['url'], scope.url(str(record['index'])))
+			self.assertEqual(sorted(record['id'] for record in records[3:]), ['0', '1', '2'])
+		# a completely read stream leaves the connection to be reused
+		self.assertEqual(self.client.connections_created, 1)
+
+	def test_stream_closed_early(self):
+		with self.client.scope() as scope:
+			records = scope.stream_request(self.fan_out(scope, 3), callbacks = 3)
+			self.assertEqual(next(records)['type'], 'result')
+			records.close()
+		# the partially read connection is dropped, the next request opens a new one
+		self.assertEqual(self.client.local.connections, {})
+		with self.client.scope() as scope:
+			records = list(scope.stream_request(self.fan_out(scope, 1), callbacks = 1))
+		self.assertEqual([record['type'] for record in records], ['result', 'callback'])
+		self.assertEqual(self.client.connections_created, 2)
+
+class ConcurrentTestRunnerTest(unittest.TestCase):
+	def setUp(self):
+		import test
+		self.test = test
+		# setUpModule creates the module client and server when they are None, and the server cannot be restarted
+		for name in ('client', 'server'):
+			self.addCleanup(setattr, test, name, getattr(test, name))
+			setattr(test, name, None)
+		endpoint = os.environ.get('SERVICE_ENDPOINT')
+		def restore():
+			if endpoint is None:
+				os.environ.pop('SERVICE_ENDPOINT', None)
+			else:
+				os.environ['SERVICE_ENDPOINT'] = endpoint
+		self.addCleanup(restore)
+
+	def run_suite(self):
+		suite = unittest.TestLoader().loadTestsFromName('TraceContextTest', module = self.test)
+		return suite.countTestCases(), self.test.ConcurrentTestRunner(4, stream = io.StringIO()).run(suite)
+
+	def test_demo_server(self):
+		from self_test import DemoServer
+		with DemoServer() as service:
+			os.environ['SERVICE_ENDPOINT'] = 'http://{}:{}/'.format(service.host, service.port)
+			count, result = self.run_suite()
+		self.assertEqual(result.testsRun, count)
+		self.assertEqual(result.errors, [])
+		self.assertEqual(result.failures, [])
+
+	def test_setup_failure(self):
+		os.environ.pop('SERVICE_ENDPOINT', None)
+		count, result = self.run_suite()
+		self.assertEqual(result.testsRun, 0)
+		self.assertEqual(len(result.errors), 1)
+		self.assertIn('SERVICE_ENDPOINT', result.errors[0][1])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,8 +1,25 @@
-from .traceparent import BaseTraceparent, Traceparent
-from .tracestate import Tracestate
+from .batch import TraceparentBatch, TracestateBatch, parse_traceparents, parse_tracestates
+from .cache import ParseCache
+from .failure import ParseFailure
+from .idgenerator import BufferedRandomIdGenerator, IdGenerator, RandomIdGenerator
+from .traceparent import BaseTraceparent, CompactTraceparent, FrozenTraceparent, Traceparent
+from .tracestate import CompactTracestate, Tracestate, TracestateKeyRegistry
 
 __all__ = (
 	'BaseTraceparent',
+	'BufferedRandomIdGenerator',
+	'CompactTraceparent',
+	'CompactTracestate',
+	'FrozenTraceparent',
+	'IdGenerator',
+	'ParseCache',
+	'ParseFailure',
+	'RandomIdGenerator',
 	'Traceparent',
+	'TraceparentBatch',
 	'Tracestate',
+	'TracestateBatch',
+	'TracestateKeyRegistry',
+	'parse_traceparents',
+	'parse_tracestates',
 )
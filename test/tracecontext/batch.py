@@ -0,0 +1,113 @@
+from binascii import unhexlify
+from .traceparent import Traceparent
+from .tracestate import Tracestate
+
+def _rows(values):
+	# a single buffer holds one header value per line, anything else is an iterable of values
+	if isinstance(values, (str, bytes, bytearray, memoryview)):
+		newline, carriage_return = ('\n', '\r') if isinstance(values, str) else (b'\n', b'\r')
+		values = bytes(values).split(newline) if isinstance(values, memoryview) else values.split(newline)
+		if not values[-1]:
+			values.pop()
+		return map(lambda line: line[:-1] if line.endswith(carriage_return) else line, values)
+	return values
+
+class TraceparentBatch(object):
+	'''
+	Columnar result of parse_traceparents. Row i of trace_id is trace_id[16 * i:16 * (i + 1)], of parent_id is
+	parent_id[8 * i:8 * (i + 1)] and of trace_flags is trace_flags[i]. Invalid rows have valid[i] == 0 and all zero columns.
+	'''
+	def __init__(self):
+		self.trace_id = bytearray()
+		self.parent_id = bytearray()
+		self.trace_flags = bytearray()
+		self.valid = bytearray()
+
+	def __len__(self):
+		return len(self.valid)
+
+	def __getitem__(self, idx):
+		if not self.valid[idx]:
+			return None
+		idx = range(len(self))[idx]
+		return Traceparent._from_fields(b'\0', bytes(self.trace_id[16 * idx:16 * (idx + 1)]), bytes(self.parent_id[8 * idx:8 * (idx + 1)]), bytes(self.trace_flags[idx:idx + 1]))
+
+	def count_valid(self):
+		return len(self) - self.valid.count(0)
+
+	def to_numpy(self):
+		# numpy is optional, the arrays share memory with the columns
+		import numpy
+		return {
+			'trace_id': numpy.frombuffer(self.trace_id, dtype = numpy.uint8).reshape(-1, 16),
+			'parent_id': numpy.frombuffer(self.parent_id, dtype = numpy.uint8).reshape(-1, 8),
+			'trace_flags': numpy.frombuffer(self.trace_flags, dtype = numpy.uint8),
+			'valid': numpy.frombuffer(self.valid, dtype = numpy.bool_),
+		}
+
+class TracestateBatch(object):
+	'''
+	Result of parse_tracestates, tracestates[i] is None where valid[i] == 0.
+	'''
+	def __init__(self):
+		self.tracestates = []
+		self.valid = bytearray()
+
+	def __len__(self):
+		return len(self.valid)
+
+	def __getitem__(self, idx):
+		return self.tracestates[idx]
+
+	def count_valid(self):
+		return len(self) - self.valid.count(0)
+
+def parse_traceparents(values):
+	'''
+	Parses an iterable of traceparent values, or a newline-delimited buffer, with the same rules as Traceparent.from_string,
+	except that values with missing fields (e.g. '00' or '00-<trace_id>') are invalid instead of getting generated ids.
+	'''
+	batch = TraceparentBatch()
+	trace_id = batch.trace_id
+	parent_id = batch.parent_id
+	trace_flags = batch.trace_flags
+	valid = batch.valid
+	match = Traceparent._VERSION_00_FORMAT_RE.fullmatch
+	match_bytes = Traceparent._VERSION_00_BYTES_FORMAT_RE.fullmatch
+	zero_trace_id = Traceparent._ZERO_TRACE_ID
+	zero_parent_id = Traceparent._ZERO_PARENT_ID
+	# a version 00 value only parses if it has the fixed 55 characters layout, so no other path is needed
+	for value in _rows(values):
+		raw = None
+		if isinstance(value, str):
+			if len(value) == 55 and match(value):
+				raw = bytes.fromhex(value.replace('-', ' '))
+		elif isinstance(value, (bytes, bytearray, memoryview)):
+			if len(value) == 55 and match_bytes(value):
+				raw = unhexlify(bytes(value).replace(b'-', b''))
+		if raw is not None:
+			if raw[1:17] != zero_trace_id and raw[17:25] != zero_parent_id:
+				trace_id += raw[1:17]
+				parent_id += raw[17:25]
+				trace_flags.append(raw[25])
+				valid.append(1)
+				continue
+		trace_id += zero_trace_id
+		parent_id += zero_parent_id
+		trace_flags.append(0)
+		valid.append(0)
+	return batch
+
+def parse_tracestates(values):
+	'''
+	Parses an iterable of tracestate values, or a newline-delimited buffer, into Tracestate objects.
+	'''
+	batch = TracestateBatch()
+	for value in _rows(values):
+		try:
+			tracestate = Tracestate(value) if isinstance(value, (str, bytes, bytearray, memoryview)) else None
+		except ValueError:
+			tracestate = None
+		batch.tracestates.append(tracestate)
+		batch.valid.append(tracestate is not None)
+	return batch
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+import threading
+
+class ParseCache(object):
+	'''
+	Bounded LRU table of parsed header values, keyed by (class, raw header value). Set it as parse_cache of BaseTraceparent
+	or Tracestate (or a subclass), one cache can be shared by several classes and threads. Only headers which parse are
+	cached, callers get a copy of the cached result and never the cached object itself.
+	'''
+	def __init__(self, max_entries = 1024):
+		if max_entries < 1:
+			raise ValueError('max_entries must be at least 1')
+		self.max_entries = max_entries
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __contains__(self, key):
+		return key in self._entries
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __repr__(self):
+		return '{}(max_entries={})'.format(type(self).__name__, self.max_entries)
+
+	def get(self, key, parse, *args):
+		'''
+		returns the cached result for key, or the result of parse(*args) which is cached if it does not raise
+		'''
+		entries = self._entries
+		with self._lock:
+			value = entries.get(key)
+			if value is not None:
+				entries.move_to_end(key)
+				self.hits += 1
+				return value
+			self.misses += 1
+		# parse outside of the lock, two threads missing the same key at once both parse it and the first one is kept
+		value = parse(*args)
+		with self._lock:
+			value = entries.setdefault(key, value)
+			entries.move_to_end(key)
+			if len(entries) > self.max_entries:
+				entries.popitem(last = False)
+				self.evictions += 1
+		return value
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def hit_rate(self):
+		total = self.hits + self.misses
+		return self.hits / total if total else 0.0
+
+	def reset_stats(self):
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
@@ -0,0 +1,19 @@
+from enum import IntEnum
+
+class ParseFailure(IntEnum):
+	'''
+	Reason returned by try_parse instead of raising ValueError, every member is truthy.
+	'''
+	UNSUPPORTED_TYPE = 1
+	NON_ASCII = 2
+	FIELD_COUNT = 3
+	VERSION_FORMAT = 4
+	VERSION_FORBIDDEN = 5
+	VERSION_UNSUPPORTED = 6
+	TRACE_ID_FORMAT = 7
+	TRACE_ID_ZERO = 8
+	PARENT_ID_FORMAT = 9
+	PARENT_ID_ZERO = 10
+	TRACE_FLAGS_FORMAT = 11
+	MEMBER_FORMAT = 12
+	SIZE_LIMIT = 13
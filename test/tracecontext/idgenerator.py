@@ -0,0 +1,88 @@
+import os
+import threading
+
+_ZERO_TRACE_ID = b'\0' * 16
+_ZERO_PARENT_ID = b'\0' * 8
+
+# bumped in forked children so they never reuse random bytes buffered by the parent process
+_fork_generation = 0
+
+def _after_fork():
+	global _fork_generation
+	_fork_generation += 1
+
+# there is no fork (and no register_at_fork) on Windows
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child = _after_fork)
+
+class IdGenerator(object):
+	'''
+	Source of new trace_id (16 bytes) and parent_id (8 bytes) values, neither of which may be all zero.
+	'''
+	# True if at least the right-most 7 bytes of every trace_id are uniformly random,
+	# which allows the random-trace-id flag to be set (Trace Context Level 2)
+	random_trace_id = False
+
+	def generate_trace_id(self):
+		raise NotImplementedError()
+
+	def generate_parent_id(self):
+		raise NotImplementedError()
+
+class RandomIdGenerator(IdGenerator):
+	'''
+	Reads every id straight from os.urandom.
+	'''
+	random_trace_id = True
+
+	def generate_trace_id(self):
+		while True:
+			trace_id = os.urandom(16)
+			if trace_id != _ZERO_TRACE_ID:
+				return trace_id
+
+	def generate_parent_id(self):
+		while True:
+			parent_id = os.urandom(8)
+			if parent_id != _ZERO_PARENT_ID:
+				return parent_id
+
+class BufferedRandomIdGenerator(IdGenerator):
+	'''
+	Slices ids from a per thread buffer which is refilled from os.urandom every buffer_size bytes.
+	'''
+	random_trace_id = True
+
+	def __init__(self, buffer_size = 4096):
+		if buffer_size < 16:
+			raise ValueError('buffer_size must be at least 16 bytes')
+		self.buffer_size = buffer_size
+		self._local = threading.local()
+
+	def _read(self, size):
+		local = self._local
+		try:
+			offset = local.offset
+			buffer = local.buffer
+			if local.generation != _fork_generation:
+				offset = self.buffer_size
+		except AttributeError:
+			offset = self.buffer_size
+		if offset + size > self.buffer_size:
+			buffer = local.buffer = os.urandom(self.buffer_size)
+			local.generation = _fork_generation
+			offset = 0
+		local.offset = offset + size
+		return buffer[offset:offset + size]
+
+	def generate_trace_id(self):
+		while True:
+			trace_id = self._read(16)
+			if trace_id != _ZERO_TRACE_ID:
+				return trace_id
+
+	def generate_parent_id(self):
+		while True:
+			parent_id = self._read(8)
+			if parent_id != _ZERO_PARENT_ID:
+				return parent_id
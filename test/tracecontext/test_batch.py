@@ -0,0 +1,59 @@
+import unittest
+from tracecontext import Traceparent, parse_traceparents, parse_tracestates
+
+TRACEPARENTS = [
+	'00-12345678901234567890123456789012-1234567890123456-01',
+	'00-00000000000000000000000000000000-1234567890123456-01',
+	'00-12345678901234567890123456789012-0000000000000000-01',
+	'01-12345678901234567890123456789012-1234567890123456-01',
+	'00-ABCDEF78901234567890123456789012-1234567890123456-01',
+	'00-12345678901234567890123456789012-1234567890123456-01-',
+	'',
+	'00',
+	'00-12345678901234567890123456789012',
+	'00-12345678901234567890123456789012-1234567890123456',
+	'00-abcdef78901234567890123456789012-abcdef7890123456-ff',
+]
+
+class BatchTest(unittest.TestCase):
+	def test_parse_traceparents(self):
+		batch = parse_traceparents(TRACEPARENTS)
+		self.assertEqual(len(batch), len(TRACEPARENTS))
+		self.assertEqual(batch.count_valid(), 2)
+		for idx, value in enumerate(TRACEPARENTS):
+			try:
+				expected = Traceparent.from_string(value)
+			except (TypeError, ValueError):
+				expected = None
+			# from_string generates missing ids, a batch rejects values with missing fields
+			if value.count('-') < 3:
+				expected = None
+			self.assertEqual(batch.valid[idx], int(expected is not None), value)
+			if expected is None:
+				self.assertIsNone(batch[idx])
+				self.assertEqual(batch.trace_id[16 * idx:16 * (idx + 1)], b'\0' * 16)
+			else:
+				self.assertEqual(str(batch[idx]), str(expected))
+				self.assertEqual(batch.trace_id[16 * idx:16 * (idx + 1)], expected.trace_id)
+				self.assertEqual(batch.parent_id[8 * idx:8 * (idx + 1)], expected.parent_id)
+				self.assertEqual(batch.trace_flags[idx], expected.trace_flags)
+		self.assertEqual(str(batch[-1]), TRACEPARENTS[-1])
+
+	def test_parse_traceparents_buffer(self):
+		buffer = '\r\n'.join(TRACEPARENTS) + '\n'
+		for value in (buffer, buffer.encode('ascii'), memoryview(buffer.encode('ascii'))):
+			batch = parse_traceparents(value)
+			self.assertEqual(list(batch.valid), list(parse_traceparents(TRACEPARENTS).valid))
+		self.assertEqual(len(parse_traceparents('')), 0)
+
+	def test_parse_tracestates(self):
+		batch = parse_tracestates('foo=1,bar=2\nfoobarbaz\n\nbaz=3')
+		self.assertEqual(len(batch), 4)
+		self.assertEqual(list(batch.valid), [1, 0, 1, 1])
+		self.assertEqual(batch[0].to_string(), 'foo=1,bar=2')
+		self.assertIsNone(batch[1])
+		self.assertEqual(batch[2].to_string(), '')
+		self.assertEqual(batch.count_valid(), 3)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,111 @@
+import threading
+import unittest
+from tracecontext import BaseTraceparent, ParseCache, Traceparent, Tracestate
+
+TRACEPARENT = '00-12345678901234567890123456789012-1234567890123456-01'
+
+class ParseCacheTest(unittest.TestCase):
+	def test_lru(self):
+		cache = ParseCache(max_entries = 2)
+		self.assertEqual(cache.get('a', str.upper, 'a'), 'A')
+		self.assertEqual(cache.get('b', str.upper, 'b'), 'B')
+		self.assertEqual(cache.get('a', str.upper, 'x'), 'A')
+		cache.get('c', str.upper, 'c')
+		self.assertTrue('a' in cache)
+		self.assertFalse('b' in cache)
+		self.assertEqual(len(cache), 2)
+		self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 3, 1))
+		self.assertEqual(cache.hit_rate(), 0.25)
+		cache.reset_stats()
+		self.assertEqual((cache.hits, cache.misses, cache.evictions), (0, 0, 0))
+		cache.clear()
+		self.assertEqual(len(cache), 0)
+		self.assertRaises(ValueError, lambda: ParseCache(max_entries = 0))
+
+	def test_failure_not_cached(self):
+		cache = ParseCache()
+		self.assertRaises(ValueError, lambda: cache.get('x', int, 'x'))
+		self.assertFalse('x' in cache)
+		self.assertEqual(cache.misses, 1)
+
+	def test_traceparent(self):
+		class CachedTraceparent(Traceparent):
+			parse_cache = ParseCache()
+		first = CachedTraceparent.from_string(TRACEPARENT)
+		first.trace_flags = 0
+		second = CachedTraceparent.from_string(TRACEPARENT.encode('ascii'))
+		third = CachedTraceparent.from_string(TRACEPARENT)
+		self.assertIsNot(first, third)
+		self.assertIsInstance(third, CachedTraceparent)
+		self.assertEqual(str(first), TRACEPARENT[:-2] + '00')
+		self.assertEqual(str(second), TRACEPARENT)
+		self.assertEqual(str(third), TRACEPARENT)
+		self.assertEqual(CachedTraceparent.parse_cache.hits, 1)
+		self.assertEqual(CachedTraceparent.parse_cache.misses, 2)
+		# only str and bytes are used as keys
+		CachedTraceparent.from_string(bytearray(TRACEPARENT, 'ascii'))
+		self.assertEqual(CachedTraceparent.parse_cache.misses, 2)
+		self.assertRaises(ValueError, lambda: CachedTraceparent.from_string('00-00000000000000000000000000000000-1234567890123456-01'))
+
+	def test_traceparent_partial(self):
+		# missing ids are generated on every call, never cached
+		class CachedTraceparent(Traceparent):
+			parse_cache = ParseCache()
+		for value in ('00', '00-12345678901234567890123456789012', b'00-12345678901234567890123456789012'):
+			first = CachedTraceparent.from_string(value)
+			second = CachedTraceparent.from_string(value)
+			self.assertNotEqual(first.parent_id, second.parent_id)
+		self.assertEqual(len(CachedTraceparent.parse_cache), 0)
+		self.assertEqual(CachedTraceparent.parse_cache.misses, 0)
+
+	def test_traceparent_classes(self):
+		# a value cached for a lenient class must not skip the checks of a strict one sharing the cache
+		value = '00-00000000000000000000000000000000-1234567890123456-01'
+		cache = ParseCache()
+		class CachedBaseTraceparent(BaseTraceparent):
+			parse_cache = cache
+		class CachedTraceparent(Traceparent):
+			parse_cache = cache
+		self.assertEqual(str(CachedBaseTraceparent.from_string(value)), value)
+		self.assertRaises(ValueError, lambda: CachedTraceparent.from_string(value))
+
+	def test_tracestate(self):
+		class CachedTracestate(Tracestate):
+			parse_cache = ParseCache()
+		first = CachedTracestate('congo=1, rojo=2')
+		first['foo'] = '3'
+		first.pop()
+		second = CachedTracestate('congo=1, rojo=2')
+		self.assertEqual(first.to_string(), 'foo=3,congo=1')
+		self.assertEqual(second.to_string(), 'congo=1,rojo=2')
+		self.assertEqual(len(second), 2)
+		self.assertEqual(second['rojo'], '2')
+		self.assertEqual(CachedTracestate.parse_cache.hits, 1)
+		self.assertRaises(ValueError, lambda: CachedTracestate('congo=1,rojo'))
+		self.assertEqual(len(CachedTracestate.parse_cache), 1)
+		self.assertEqual(CachedTracestate('').to_string(), '')
+
+	def test_threads(self):
+		class CachedTraceparent(Traceparent):
+			parse_cache = ParseCache(max_entries = 8)
+		values = ['00-{:032x}-{:016x}-01'.format(idx + 1, idx + 1) for idx in range(16)]
+		errors = []
+		def worker():
+			for _ in range(100):
+				for value in values:
+					if CachedTraceparent.from_string(value).to_string() != value:
+						errors.append(value)
+		threads = [threading.Thread(target = worker) for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		cache = CachedTraceparent.parse_cache
+		self.assertEqual(errors, [])
+		self.assertLessEqual(len(cache), 8)
+		self.assertEqual(cache.hits + cache.misses, 4 * 100 * 16)
+		# concurrent misses of the same value are counted once per thread but stored once
+		self.assertGreaterEqual(cache.misses - cache.evictions, len(cache))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,80 @@
+import os
+import threading
+import unittest
+from tracecontext import BufferedRandomIdGenerator, IdGenerator, RandomIdGenerator, Traceparent
+
+class IdGeneratorTest(unittest.TestCase):
+	def test_generate(self):
+		for generator in (RandomIdGenerator(), BufferedRandomIdGenerator(), BufferedRandomIdGenerator(buffer_size = 20)):
+			trace_ids = set()
+			parent_ids = set()
+			for _ in range(1000):
+				trace_id = generator.generate_trace_id()
+				parent_id = generator.generate_parent_id()
+				self.assertIsInstance(trace_id, bytes)
+				self.assertEqual(len(trace_id), 16)
+				self.assertIsInstance(parent_id, bytes)
+				self.assertEqual(len(parent_id), 8)
+				trace_ids.add(trace_id)
+				parent_ids.add(parent_id)
+			self.assertEqual(len(trace_ids), 1000)
+			self.assertEqual(len(parent_ids), 1000)
+			self.assertTrue(generator.random_trace_id)
+
+	def test_buffer_size(self):
+		self.assertRaises(ValueError, lambda: BufferedRandomIdGenerator(buffer_size = 15))
+
+	def test_threads(self):
+		generator = BufferedRandomIdGenerator()
+		results = []
+		def worker():
+			results.append([generator.generate_trace_id() for _ in range(1000)])
+		threads = [threading.Thread(target = worker) for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(len(set(sum(results, []))), 4000)
+
+	@unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+	def test_fork(self):
+		generator = BufferedRandomIdGenerator()
+		generator.generate_trace_id()
+		rfd, wfd = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			os.close(rfd)
+			os.write(wfd, generator.generate_trace_id())
+			os._exit(0)
+		os.close(wfd)
+		child = os.read(rfd, 16)
+		os.close(rfd)
+		os.waitpid(pid, 0)
+		self.assertNotEqual(child, generator.generate_trace_id())
+
+	def test_traceparent(self):
+		class CountingIdGenerator(IdGenerator):
+			def __init__(self):
+				self.count = 0
+
+			def generate_trace_id(self):
+				self.count += 1
+				return self.count.to_bytes(16, 'big')
+
+			def generate_parent_id(self):
+				self.count += 1
+				return self.count.to_bytes(8, 'big')
+
+		class CountingTraceparent(Traceparent):
+			id_generator = CountingIdGenerator()
+
+		traceparent = CountingTraceparent()
+		self.assertEqual(str(traceparent), '00-00000000000000000000000000000001-0000000000000002-00')
+		traceparent = CountingTraceparent.new_trace(Traceparent.FLAG_SAMPLED)
+		self.assertEqual(str(traceparent), '00-00000000000000000000000000000003-0000000000000004-01')
+
+		traceparent = Traceparent.new_trace(Traceparent.FLAG_SAMPLED)
+		self.assertEqual(traceparent.trace_flags, Traceparent.FLAG_SAMPLED | Traceparent.FLAG_RANDOM)
+
+if __name__ == '__main__':
+	unittest.main()
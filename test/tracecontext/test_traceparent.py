@@ -1,5 +1,5 @@
 import unittest
-from tracecontext import BaseTraceparent, Traceparent
+from tracecontext import BaseTraceparent, CompactTraceparent, FrozenTraceparent, ParseFailure, Traceparent
 
 class BaseTraceparentTest(unittest.TestCase):
 	def test_ctor_default(self):
@@ -77,6 +77,106 @@ class BaseTraceparentTest(unittest.TestCase):
 		self.assertRaises(ValueError, lambda: BaseTraceparent.from_string('00-12345678901234567890123456789012-123456789012345-00'))
 		self.assertRaises(ValueError, lambda: BaseTraceparent.from_string('00-12345678901234567890123456789012-12345678901234567-00'))
 
+	def test_from_string_version_00(self):
+		# the fixed layout fast path must agree with the generic path
+		headers = [
+			'00-12345678901234567890123456789012-1234567890123456-00',
+			'00-00000000000000000000000000000000-0000000000000000-ff',
+			'00-abcdefabcdefabcdefabcdefabcdefab-abcdefabcdefabcd-01',
+			'00-ABCDEFABCDEFABCDEFABCDEFABCDEFAB-abcdefabcdefabcd-01',
+			'00-12345678901234567890123456789012-1234567890123456-0 ',
+			'00-12345678901234567890123456789012-123456789012345 -00',
+			'00-1234567890123456789012345678901\n-1234567890123456-00',
+			'00-12345678901234567890123456789012-1234567890123456_00',
+			'00_12345678901234567890123456789012-1234567890123456-00',
+		]
+		for header in headers:
+			for cls in (BaseTraceparent, Traceparent):
+				try:
+					expected = str(cls(*header.split('-')))
+				except (TypeError, ValueError):
+					expected = None
+				try:
+					actual = str(cls.from_string(header))
+				except (TypeError, ValueError):
+					actual = None
+				self.assertEqual(actual, expected, '{}.from_string({!r})'.format(cls.__name__, header))
+
+		traceparent = BaseTraceparent.from_string('00-12345678901234567890123456789012-1234567890123456-01')
+		self.assertEqual(traceparent.version, 0)
+		self.assertEqual(traceparent.trace_id.hex(), '12345678901234567890123456789012')
+		self.assertEqual(traceparent.parent_id.hex(), '1234567890123456')
+		self.assertEqual(traceparent.trace_flags, 1)
+		self.assertEqual(traceparent._residue, ())
+
+	def test_from_bytes(self):
+		string = '00-12345678901234567890123456789012-1234567890123456-01'
+		for value in (string.encode('ascii'), bytearray(string, 'ascii'), memoryview(string.encode('ascii'))):
+			self.assertEqual(str(BaseTraceparent.from_string(value)), string)
+			self.assertEqual(str(Traceparent.from_string(value)), string)
+		value = b'cc-12345678901234567890123456789012-1234567890123456-01-foo'
+		self.assertEqual(str(BaseTraceparent.from_string(value)), value.decode('ascii'))
+		# the buffer is validated the same way as a string
+		value = memoryview(b'xx00-12345678901234567890123456789012-1234567890123456-01')[2:]
+		self.assertEqual(str(BaseTraceparent.from_string(value)), string)
+		self.assertRaises(ValueError, lambda: BaseTraceparent.from_string(b'00-ABCDEF78901234567890123456789012-1234567890123456-01'))
+		self.assertRaises(ValueError, lambda: BaseTraceparent.from_string(b'00-1234567890123456789012345678901\xff-1234567890123456-01'))
+		self.assertRaises(ValueError, lambda: Traceparent.from_string(b'00-00000000000000000000000000000000-1234567890123456-01'))
+		self.assertRaises(ValueError, lambda: BaseTraceparent.from_string(123))
+
+	def test_try_parse(self):
+		# try_parse must accept and reject exactly what from_string does
+		headers = [
+			'00-12345678901234567890123456789012-1234567890123456-01',
+			'00-00000000000000000000000000000000-1234567890123456-01',
+			'00-12345678901234567890123456789012-0000000000000000-01',
+			'01-12345678901234567890123456789012-1234567890123456-01',
+			'cc-12345678901234567890123456789012-1234567890123456-01-what-the-future-will-be-like',
+			'ff-12345678901234567890123456789012-1234567890123456-01',
+			'0-12345678901234567890123456789012-1234567890123456-01',
+			'00-1234567890123456789012345678901-1234567890123456-01',
+			'00-12345678901234567890123456789012-123456789012345-01',
+			'00-12345678901234567890123456789012-1234567890123456-1',
+			'00-ABCDEF78901234567890123456789012-1234567890123456-01',
+			'00-12345678901234567890123456789012-1234567890123456-01\n',
+			'00-12345678901234567890123456789012',
+			'00',
+			'00\n',
+			'00\n-12345678901234567890123456789012',
+			'00-12345678901234567890123456789012\n',
+			'00-12345678901234567890123456789012-1234567890123456\n-01',
+			'',
+			b'00\n',
+			b'00-12345678901234567890123456789012-1234567890123456-01',
+			b'00-00000000000000000000000000000000-1234567890123456-01',
+			b'00-1234567890123456789012345678901\xff-1234567890123456-01',
+			123,
+		]
+		for header in headers:
+			for cls in (BaseTraceparent, Traceparent):
+				try:
+					cls.from_string(header)
+					expected = True
+				except (TypeError, ValueError):
+					expected = False
+				actual = not isinstance(cls.try_parse(header), ParseFailure)
+				self.assertEqual(actual, expected, '{}.try_parse({!r})'.format(cls.__name__, header))
+		string = 'cc-12345678901234567890123456789012-1234567890123456-01-what-the-future-will-be-like'
+		self.assertEqual(str(BaseTraceparent.try_parse(string)), string)
+		string = '00-12345678901234567890123456789012-1234567890123456-01'
+		self.assertEqual(str(Traceparent.try_parse(string)), string)
+		self.assertEqual(str(Traceparent.try_parse(string.encode('ascii'))), string)
+		self.assertEqual(BaseTraceparent.try_parse(123), ParseFailure.UNSUPPORTED_TYPE)
+		self.assertEqual(BaseTraceparent.try_parse(b'00-\xff'), ParseFailure.NON_ASCII)
+		self.assertEqual(BaseTraceparent.try_parse('ff-12345678901234567890123456789012-1234567890123456-01'), ParseFailure.VERSION_FORBIDDEN)
+		self.assertEqual(BaseTraceparent.try_parse('00-1234567890123456789012345678901-1234567890123456-01'), ParseFailure.TRACE_ID_FORMAT)
+		self.assertEqual(BaseTraceparent.try_parse('00-12345678901234567890123456789012-123456789012345-01'), ParseFailure.PARENT_ID_FORMAT)
+		self.assertEqual(BaseTraceparent.try_parse('00-12345678901234567890123456789012-1234567890123456-1'), ParseFailure.TRACE_FLAGS_FORMAT)
+		self.assertEqual(Traceparent.try_parse('01-12345678901234567890123456789012-1234567890123456-01'), ParseFailure.VERSION_UNSUPPORTED)
+		self.assertEqual(Traceparent.try_parse('00-00000000000000000000000000000000-1234567890123456-01'), ParseFailure.TRACE_ID_ZERO)
+		self.assertEqual(Traceparent.try_parse(b'00-12345678901234567890123456789012-0000000000000000-01'), ParseFailure.PARENT_ID_ZERO)
+		self.assertEqual(Traceparent.try_parse('00-12345678901234567890123456789012-1234567890123456-01-00'), ParseFailure.FIELD_COUNT)
+
 	def test_repr(self):
 		string = '12-12345678901234567890123456789012-1234567890123456-ff'
 		traceparent = BaseTraceparent.from_string('12-12345678901234567890123456789012-1234567890123456-ff')
@@ -140,6 +240,34 @@ class TraceparentTest(unittest.TestCase):
 		traceparent = Traceparent.from_string('00-12345678901234567890123456789012-1234567890123456-ff')
 		self.assertEqual(str(traceparent), string)
 
+	def test_str_cache(self):
+		traceparent = Traceparent.from_string('00-12345678901234567890123456789012-1234567890123456-00')
+		traceparent.trace_id = 'ffffffffffffffffffffffffffffffff'
+		self.assertEqual(str(traceparent), '00-ffffffffffffffffffffffffffffffff-1234567890123456-00')
+		traceparent.parent_id = b'\xff' * 8
+		self.assertEqual(str(traceparent), '00-ffffffffffffffffffffffffffffffff-ffffffffffffffff-00')
+		traceparent.trace_flags = 1
+		self.assertEqual(str(traceparent), '00-ffffffffffffffffffffffffffffffff-ffffffffffffffff-01')
+		self.assertRaises(ValueError, lambda: traceparent.set_parent_id(None))
+		self.assertEqual(str(traceparent), '00-ffffffffffffffffffffffffffffffff-ffffffffffffffff-01')
+
+	def test_child(self):
+		string = '00-12345678901234567890123456789012-1234567890123456-01'
+		traceparent = Traceparent.from_string(string)
+		child = traceparent.child()
+		self.assertEqual(child.trace_id, traceparent.trace_id)
+		self.assertNotEqual(child.parent_id, traceparent.parent_id)
+		self.assertEqual(child.trace_flags, traceparent.trace_flags)
+		self.assertEqual(str(child), '00-12345678901234567890123456789012-{}-01'.format(child.parent_id.hex()))
+		self.assertEqual(str(traceparent), string)
+
+		child = traceparent.child('ffffffffffffffff')
+		self.assertEqual(str(child), '00-12345678901234567890123456789012-ffffffffffffffff-01')
+		child.trace_flags = 0
+		self.assertEqual(str(child), '00-12345678901234567890123456789012-ffffffffffffffff-00')
+		self.assertRaises(ValueError, lambda: traceparent.child(b'\0' * 8))
+		self.assertRaises(ValueError, lambda: traceparent.child('fff'))
+
 	def test_set_version(self):
 		traceparent = Traceparent()
 		traceparent.set_version(0)
@@ -153,5 +281,110 @@ class TraceparentTest(unittest.TestCase):
 		traceparent = Traceparent()
 		self.assertRaises(ValueError, lambda: traceparent.set_parent_id(None))
 
+class CompactTraceparentTest(unittest.TestCase):
+	def test_ctor(self):
+		traceparent = CompactTraceparent(trace_id = '12345678901234567890123456789012', parent_id = '1234567890123456', trace_flags = 1)
+		self.assertEqual(traceparent.version, 0)
+		self.assertEqual(traceparent.trace_id.hex(), '12345678901234567890123456789012')
+		self.assertEqual(traceparent.parent_id.hex(), '1234567890123456')
+		self.assertEqual(traceparent.trace_flags, 1)
+		self.assertRaises(ValueError, lambda: CompactTraceparent(version = 1))
+		self.assertRaises(ValueError, lambda: CompactTraceparent(trace_id = b'\0' * 16))
+		self.assertFalse(hasattr(traceparent, '__dict__'))
+
+	def test_from_string(self):
+		string = '00-12345678901234567890123456789012-1234567890123456-ff'
+		traceparent = CompactTraceparent.from_string(string)
+		self.assertEqual(str(traceparent), string)
+		self.assertEqual(repr(traceparent), 'CompactTraceparent({!r})'.format(string))
+		self.assertEqual(str(traceparent.to_traceparent()), string)
+		self.assertRaises(ValueError, lambda: CompactTraceparent.from_string('01-12345678901234567890123456789012-1234567890123456-00'))
+
+	def test_from_traceparent(self):
+		string = '00-12345678901234567890123456789012-1234567890123456-01'
+		self.assertEqual(str(CompactTraceparent.from_traceparent(BaseTraceparent.from_string(string))), string)
+		self.assertRaises(ValueError, lambda: CompactTraceparent.from_traceparent(BaseTraceparent.from_string('cc' + string[2:] + '-foo')))
+		self.assertRaises(ValueError, lambda: CompactTraceparent.from_traceparent(BaseTraceparent.from_string('cc' + string[2:])))
+		self.assertRaises(ValueError, lambda: CompactTraceparent.from_traceparent(BaseTraceparent()))
+
+	def test_setters(self):
+		traceparent = CompactTraceparent.from_string('00-12345678901234567890123456789012-1234567890123456-00')
+		traceparent.parent_id = 'ffffffffffffffff'
+		traceparent.trace_flags = 2
+		self.assertEqual(str(traceparent), '00-12345678901234567890123456789012-ffffffffffffffff-02')
+		with self.assertRaises(ValueError):
+			traceparent.trace_id = None
+		self.assertEqual(str(traceparent), '00-12345678901234567890123456789012-ffffffffffffffff-02')
+
+class FrozenTraceparentTest(unittest.TestCase):
+	def test_hash_eq(self):
+		string = '00-12345678901234567890123456789012-1234567890123456-01'
+		first = FrozenTraceparent.from_string(string)
+		second = FrozenTraceparent.from_traceparent(Traceparent.from_string(string.encode('ascii')))
+		third = FrozenTraceparent.from_string(string[:-2] + '00')
+		self.assertEqual(first, second)
+		self.assertEqual(hash(first), hash(second))
+		self.assertNotEqual(first, third)
+		self.assertNotEqual(first, CompactTraceparent.from_string(string))
+		self.assertNotEqual(first, string)
+		self.assertEqual(len({first, second, third}), 2)
+		self.assertEqual({first: 1}[second], 1)
+		self.assertEqual(repr(first), 'FrozenTraceparent({!r})'.format(string))
+
+	def test_immutable(self):
+		traceparent = FrozenTraceparent.from_string('00-12345678901234567890123456789012-1234567890123456-01')
+		with self.assertRaises(AttributeError):
+			traceparent.trace_flags = 0
+		with self.assertRaises(AttributeError):
+			traceparent.parent_id = 'ffffffffffffffff'
+		with self.assertRaises(AttributeError):
+			traceparent.foo = 1
+		with self.assertRaises(AttributeError):
+			traceparent._data = b'\0' * 26
+		with self.assertRaises(AttributeError):
+			del traceparent._data
+		self.assertEqual(str(traceparent), '00-12345678901234567890123456789012-1234567890123456-01')
+		# the mutable copy is unaffected by the frozen one and the other way round
+		copy = traceparent.to_traceparent()
+		copy.trace_flags = 0
+		self.assertEqual(traceparent.trace_flags, 1)
+
+	def test_bytes(self):
+		traceparent = FrozenTraceparent.from_string('00-12345678901234567890123456789012-1234567890123456-01')
+		data = traceparent.to_bytes()
+		self.assertEqual(len(data), 26)
+		self.assertEqual(FrozenTraceparent.from_bytes(data), traceparent)
+		self.assertRaises(ValueError, lambda: FrozenTraceparent.from_bytes(data[:-1]))
+		self.assertRaises(ValueError, lambda: FrozenTraceparent.from_bytes(data[:1] + b'\0' * 16 + data[17:]))
+		self.assertRaises(ValueError, lambda: FrozenTraceparent.from_bytes(b'\1' + data[1:]))
+
+	def test_same_checks(self):
+		# both constructors reject what Traceparent rejects
+		valid = Traceparent.from_string('00-12345678901234567890123456789012-1234567890123456-01')
+		for traceparent in (BaseTraceparent(0, valid.trace_id), BaseTraceparent(0, None, valid.parent_id), BaseTraceparent(1, valid.trace_id, valid.parent_id)):
+			data = traceparent._version + traceparent._trace_id + traceparent._parent_id + traceparent._trace_flags
+			self.assertRaises(ValueError, lambda: FrozenTraceparent.from_traceparent(traceparent))
+			self.assertRaises(ValueError, lambda: FrozenTraceparent.from_bytes(data))
+		self.assertEqual(FrozenTraceparent.from_traceparent(valid), FrozenTraceparent.from_bytes(FrozenTraceparent.from_traceparent(valid).to_bytes()))
+
+	def test_copy_pickle(self):
+		import copy
+		import pickle
+		traceparent = FrozenTraceparent.from_string('00-12345678901234567890123456789012-1234567890123456-01')
+		index = {traceparent: 'span'}
+		for other in (copy.copy(traceparent), copy.deepcopy(traceparent), pickle.loads(pickle.dumps(traceparent))):
+			self.assertIsInstance(other, FrozenTraceparent)
+			self.assertEqual(other, traceparent)
+			self.assertEqual(str(other), str(traceparent))
+		self.assertEqual(copy.deepcopy(index), index)
+		self.assertEqual(pickle.loads(pickle.dumps(index)), index)
+
+	def test_int_views(self):
+		traceparent = FrozenTraceparent.from_string('00-12345678901234567890123456789012-1234567890123456-01')
+		self.assertEqual(traceparent.trace_id_int, 0x12345678901234567890123456789012)
+		self.assertEqual(traceparent.parent_id_int, 0x1234567890123456)
+		with self.assertRaises(AttributeError):
+			traceparent.trace_id_int = 1
+
 if __name__ == '__main__':
 	unittest.main()
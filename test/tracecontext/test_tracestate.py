@@ -1,5 +1,23 @@
 import unittest
-from tracecontext import Tracestate
+from tracecontext import CompactTracestate, ParseFailure, Tracestate, TracestateKeyRegistry
+
+# valid and invalid headers which every parser is expected to agree on, also used by benchmark.py
+HEADERS = [
+	'congo=1,rojo=2',
+	'congo=1 ,\trojo=2',
+	'congo=,rojo=2',
+	'congo,rojo=2',
+	'congo==1',
+	'congo=a=b',
+	'congo=1 ',
+	'congo= 1',
+	'congo=' + 'x' * 256,
+	'congo=' + 'x' * 257,
+	'congo=\x7f',
+	'rojo=1,rojo=2',
+	',,congo=1,, ,rojo@vendor=2,',
+	'a-b_c*d/e@f-g=h',
+]
 
 class TestTracestate(unittest.TestCase):
 	def test_ctor_no_arg(self):
@@ -20,10 +38,110 @@ class TestTracestate(unittest.TestCase):
 
 		self.assertRaises(ValueError, lambda: Tracestate('foobarbaz'))
 
+	def test_ctor_with_bytes(self):
+		for value in (b'foo=1, bar=2', bytearray(b'foo=1, bar=2'), memoryview(b'foo=1, bar=2')):
+			self.assertEqual(Tracestate(value).to_string(), 'foo=1,bar=2')
+		self.assertEqual(Tracestate().from_string(b'foo=1').to_string(), 'foo=1')
+		self.assertRaises(ValueError, lambda: Tracestate(b'foo=\xff'))
+		self.assertRaises(ValueError, lambda: Tracestate(b'foobarbaz'))
+
 	def test_cctor(self):
 		state = Tracestate(Tracestate('foo=1,bar=2,baz=3'))
 		self.assertEqual(state.to_string(), 'foo=1,bar=2,baz=3')
 
+	def test_keys(self):
+		self.assertEqual(Tracestate().keys(), [])
+		state = Tracestate('foo=1,bar=2')
+		copy = Tracestate(state)
+		copy['baz'] = '3'
+		self.assertEqual(copy.keys(), ['baz', 'foo', 'bar'])
+		self.assertEqual(Tracestate.lazy('foo=1 , bar=2').keys(), ['foo', 'bar'])
+		self.assertEqual(CompactTracestate('foo=1,bar=2').keys(), ['foo', 'bar'])
+
+	def test_copy_on_write(self):
+		state = Tracestate('foo=1,bar=2,baz=3')
+		self.assertEqual(state.to_string(), 'foo=1,bar=2,baz=3')
+		copy = Tracestate(state)
+		copy['bar'] = '4'
+		self.assertEqual(copy.to_string(), 'bar=4,foo=1,baz=3')
+		self.assertEqual(state.to_string(), 'foo=1,bar=2,baz=3')
+		state['qux'] = '5'
+		self.assertEqual(state.to_string(), 'qux=5,foo=1,bar=2,baz=3')
+		self.assertEqual(copy.to_string(), 'bar=4,foo=1,baz=3')
+		self.assertEqual(len(state), 4)
+		self.assertEqual(len(copy), 3)
+		self.assertEqual(copy['bar'], '4')
+		self.assertEqual(copy['baz'], '3')
+		self.assertFalse('qux' in copy)
+		self.assertRaises(KeyError, lambda: copy['qux'])
+
+		copy_of_copy = Tracestate(copy)
+		copy_of_copy['foo'] = '6'
+		self.assertEqual(copy_of_copy.pop(), ('baz', '3'))
+		copy_of_copy.from_string('quux=7')
+		self.assertEqual(copy_of_copy.to_string(), 'foo=6,bar=4,quux=7')
+		self.assertEqual(copy.to_string(), 'bar=4,foo=1,baz=3')
+		self.assertEqual(state.to_string(), 'qux=5,foo=1,bar=2,baz=3')
+
+	def test_cached_string(self):
+		# the incrementally maintained header must match a full rebuild
+		state = Tracestate('a=1,b=2,ab=3,ba=4')
+		state.to_string()
+		for key, value in [('b', '5'), ('ba', '6'), ('a', '7'), ('c', '8'), ('a', '9'), ('ab', 'a=b'.replace('=', '-'))]:
+			state = Tracestate(state)
+			state[key] = value
+			self.assertEqual(state.to_string(), ','.join(key + '=' + state[key] for key, _ in state._items()))
+		self.assertEqual(state.to_string(), 'ab=a-b,a=9,c=8,ba=6,b=5')
+		state.pop()
+		self.assertEqual(state.to_string(), 'ab=a-b,a=9,c=8,ba=6')
+		state = Tracestate('a=1')
+		state.to_string()
+		state.pop()
+		self.assertEqual(state.to_string(), '')
+
+	def test_lazy(self):
+		header = 'foo=1 , bar=2,,foo=3'
+		state = Tracestate.lazy(header)
+		# passed through verbatim while nothing is modified
+		self.assertEqual(state.to_string(), header)
+		self.assertEqual(Tracestate(state).to_string(), header)
+		self.assertTrue(state.is_valid())
+		self.assertIsNotNone(state._raw)
+		self.assertEqual(state['bar'], '2')
+		self.assertIsNone(state._raw)
+		self.assertEqual(state.to_string(), 'foo=1,bar=2')
+
+		state = Tracestate.lazy(b'foo=1,bar=2')
+		state['baz'] = '3'
+		self.assertEqual(state.to_string(), 'baz=3,foo=1,bar=2')
+		self.assertRaises(ValueError, lambda: Tracestate.lazy(b'foo=\xff'))
+		self.assertRaises(ValueError, lambda: Tracestate.lazy(None))
+
+		state = Tracestate.lazy('foo=1,foobarbaz')
+		self.assertEqual(state.to_string(), 'foo=1,foobarbaz')
+		self.assertRaises(ValueError, lambda: state['foo'])
+		self.assertRaises(ValueError, lambda: len(state))
+
+	def test_lazy_is_valid(self):
+		self.assertFalse(Tracestate.lazy('').is_valid())
+		self.assertFalse(Tracestate.lazy(' , ').is_valid())
+		self.assertTrue(Tracestate.lazy('foo=1').is_valid())
+		members = ['key{}=value'.format(idx) for idx in range(32)]
+		self.assertTrue(Tracestate.lazy(','.join(members)).is_valid())
+		self.assertFalse(Tracestate.lazy(','.join(members + ['extra=value'])).is_valid())
+		# empty members and OWS do not count, which needs a full parse
+		self.assertTrue(Tracestate.lazy(','.join(members) + ',,').is_valid())
+		self.assertTrue(Tracestate.lazy('foo=' + 'x' * 256 + ' ' * 300 + ',bar=1').is_valid())
+		self.assertFalse(Tracestate.lazy('foo=' + 'x' * 256 + ',bar=' + 'x' * 256).is_valid())
+		self.assertFalse(Tracestate.lazy('foo=' + 'x' * 256 + ',foobarbaz' * 30).is_valid())
+		# malformed members make the header invalid even if it is small enough not to need a full parse
+		self.assertFalse(Tracestate.lazy('FOO=1, a').is_valid())
+		self.assertFalse(Tracestate.lazy(' a=1').is_valid())
+		self.assertFalse(Tracestate.lazy('foo=1,bar').is_valid())
+		state = Tracestate.lazy('foo=1 , bar=2')
+		self.assertTrue(state.is_valid())
+		self.assertEqual(state.to_string(), 'foo=1 , bar=2')
+
 	def test_all_allowed_chars(self):
 		header = ''.join([
 			# key
@@ -69,6 +187,55 @@ class TestTracestate(unittest.TestCase):
 		state.from_string('foo=1')
 		self.assertNotEqual(state.to_string(), 'foo=1,bar=2,baz=3')
 
+	def test_method_try_parse(self):
+		state = Tracestate.try_parse('foo=1 ,\tbar=2,,foo=3')
+		self.assertIsInstance(state, Tracestate)
+		self.assertEqual(state.to_string(), 'foo=1,bar=2')
+		self.assertEqual(Tracestate.try_parse(b'foo=1').to_string(), 'foo=1')
+		self.assertEqual(Tracestate.try_parse('foo=1,bar'), ParseFailure.MEMBER_FORMAT)
+		self.assertEqual(Tracestate.try_parse('FOO=1'), ParseFailure.MEMBER_FORMAT)
+		self.assertEqual(Tracestate.try_parse(b'foo=\xff'), ParseFailure.NON_ASCII)
+		self.assertEqual(Tracestate.try_parse(None), ParseFailure.UNSUPPORTED_TYPE)
+		# from_string still raises
+		self.assertRaises(ValueError, lambda: Tracestate('foo=1,bar'))
+
+	def test_tokenize(self):
+		# one pass must accept, reject and drop duplicates exactly like splitting on the delimiters and matching each member
+		import random
+		import re
+		from tracecontext.tracestate import _tokenize
+		def reference(string):
+			members = {}
+			for member in re.split('[ \t]*,[ \t]*', string):
+				if member:
+					match = re.fullmatch('(%s)=(%s)' % (Tracestate._KEY_FORMAT, Tracestate._VALUE_FORMAT), member)
+					if not match:
+						return None
+					members.setdefault(match.group(1), match.group(2))
+			return list(members.items())
+		rng = random.Random(0)
+		for _ in range(5000):
+			string = ''.join(rng.choice(['a', 'b', '=', '1', ' ', '\t', ',', 'A', '@']) for _ in range(rng.randrange(16)))
+			tokens = list(_tokenize(string))
+			if tokens and tokens[-1][0] is None:
+				tokens = None
+			self.assertEqual(tokens, reference(string), repr(string))
+		# a caller owned seen is only read, the caller adds the keys it keeps
+		self.assertEqual(list(_tokenize('a=1,b=2', seen = {'a': '0'})), [('b', '2')])
+		self.assertEqual(list(_tokenize('a=1, ,b=2,c', max_members = 1)), [('a', '1'), (None, None)])
+		self.assertEqual(list(_tokenize('a=1 , b=x y z ,c')), [('a', '1'), ('b', 'x y z'), (None, 'c')])
+
+	def test_budgets(self):
+		header = 'foo=1 , ,bar=2,baz=3'
+		self.assertEqual(Tracestate().from_string(header, max_bytes = len(header), max_members = 3).to_string(), 'foo=1,bar=2,baz=3')
+		self.assertRaises(ValueError, lambda: Tracestate().from_string(header, max_bytes = len(header) - 1))
+		self.assertRaises(ValueError, lambda: Tracestate().from_string(header.encode('ascii'), max_bytes = len(header) - 1))
+		self.assertRaises(ValueError, lambda: Tracestate().from_string(header, max_members = 2))
+		self.assertEqual(Tracestate.try_parse(header, max_members = 2), ParseFailure.SIZE_LIMIT)
+		self.assertEqual(Tracestate.try_parse(b',' * 100000, max_bytes = 512), ParseFailure.SIZE_LIMIT)
+		# empty members only count against the byte budget
+		self.assertEqual(len(Tracestate.try_parse(',' * 100 + 'foo=1', max_members = 1)), 1)
+
 	def test_method_is_valid(self):
 		state = Tracestate()
 
@@ -99,6 +266,38 @@ class TestTracestate(unittest.TestCase):
 		# raise KeyError exception while trying to pop from nothing
 		self.assertRaises(KeyError, lambda: state.pop())
 
+	def test_truncate(self):
+		state = Tracestate('foo=1,bar=2')
+		self.assertEqual(state.truncate(), [])
+		self.assertEqual(state.to_string(), 'foo=1,bar=2')
+
+		# entries larger than 128 characters go first, starting from the end
+		large = 'x' * 200
+		state = Tracestate([('a', '1'), ('b', large), ('c', '2'), ('d', large), ('e', large), ('f', '3')])
+		self.assertEqual(state.truncate(), [('e', large)])
+		self.assertEqual(state.to_string(), 'a=1,b={0},c=2,d={0},f=3'.format(large))
+		self.assertTrue(state.is_valid())
+		self.assertEqual(state.truncate(max_bytes = 20), [('b', large), ('d', large)])
+		self.assertEqual(state.to_string(), 'a=1,c=2,f=3')
+		self.assertEqual(state.truncate(max_bytes = 7), [('f', '3')])
+		self.assertEqual(state.to_string(), 'a=1,c=2')
+		self.assertEqual(state.truncate(max_bytes = 0), [('a', '1'), ('c', '2')])
+		self.assertEqual(state.to_string(), '')
+
+		state = Tracestate(','.join('k{}=v'.format(idx) for idx in range(40)))
+		removed = state.truncate()
+		self.assertEqual(len(state), 32)
+		self.assertEqual(removed[0], ('k32', 'v'))
+		self.assertTrue(state.is_valid())
+
+		state = Tracestate.lazy('foo=1,bar=2')
+		self.assertEqual(state.truncate(max_bytes = 5), [('bar', '2')])
+		self.assertEqual(state.to_string(), 'foo=1')
+
+		state = CompactTracestate('foo=1,bar=2,baz=3')
+		self.assertEqual(state.truncate(max_members = 1), [('bar', '2'), ('baz', '3')])
+		self.assertEqual(state.to_string(), 'foo=1')
+
 	def test_setitem(self):
 		state = Tracestate(bar = '0')
 		state['foo'] = '1'
@@ -134,5 +333,103 @@ class TestTracestate(unittest.TestCase):
 		# throw if value exceeds 256 bytes
 		self.assertRaises(ValueError, lambda: state.__setitem__('foo', 'x' * 257))
 
+class TestCompactTracestate(unittest.TestCase):
+	def test_ctor(self):
+		self.assertEqual(CompactTracestate().to_string(), '')
+		self.assertEqual(CompactTracestate({'foo': '1'}).to_string(), 'foo=1')
+		self.assertEqual(CompactTracestate('foo=1, bar=2,foo=3').to_string(), 'foo=1,bar=2')
+		self.assertEqual(CompactTracestate(Tracestate('foo=1,bar=2')).to_string(), 'foo=1,bar=2')
+		self.assertRaises(ValueError, lambda: CompactTracestate('foobarbaz'))
+		self.assertFalse(hasattr(CompactTracestate(), '__dict__'))
+
+	def test_cctor(self):
+		state = CompactTracestate('foo=1,bar=2')
+		copy = CompactTracestate(state)
+		copy['baz'] = '3'
+		self.assertEqual(state.to_string(), 'foo=1,bar=2')
+		self.assertEqual(copy.to_string(), 'baz=3,foo=1,bar=2')
+
+	def test_mapping(self):
+		state = CompactTracestate('foo=bar,bar=foo')
+		self.assertEqual(len(state), 2)
+		self.assertEqual(state['foo'], 'bar')
+		self.assertEqual(state['bar'], 'foo')
+		self.assertTrue('foo' in state)
+		self.assertFalse('baz' in state)
+		self.assertRaises(KeyError, lambda: state['baz'])
+		state['bar'] = 'x'
+		self.assertEqual(state.to_string(), 'bar=x,foo=bar')
+		self.assertRaises(ValueError, lambda: state.__setitem__('FOO', 'abc'))
+		self.assertRaises(ValueError, lambda: state.__setitem__('foo', 'bar=baz'))
+		state.from_string('baz=1')
+		self.assertEqual(repr(state), "CompactTracestate('bar=x,foo=bar,baz=1')")
+		self.assertEqual(state.to_tracestate().to_string(), 'bar=x,foo=bar,baz=1')
+
+	def test_method_is_valid(self):
+		state = CompactTracestate()
+		self.assertFalse(state.is_valid())
+		state['foo'] = 'x' * 256
+		self.assertTrue(state.is_valid())
+		state['bar'] = 'x' * 256
+		self.assertFalse(state.is_valid())
+
+	def test_pop(self):
+		state = CompactTracestate('foo=1,bar=2')
+		self.assertEqual(state.pop(), ('bar', '2'))
+		self.assertEqual(state.pop(), ('foo', '1'))
+		self.assertRaises(KeyError, lambda: state.pop())
+
+class TestTracestateKeyRegistry(unittest.TestCase):
+	def setUp(self):
+		class RegistryTracestate(Tracestate):
+			key_registry = TracestateKeyRegistry(['congo', 'rojo', 'tenant@system'])
+		self.cls = RegistryTracestate
+		self.registry = RegistryTracestate.key_registry
+
+	def test_register(self):
+		self.assertEqual(len(self.registry), 3)
+		self.assertTrue('congo' in self.registry)
+		self.assertRaises(ValueError, lambda: self.registry.register('Congo'))
+		self.assertRaises(ValueError, lambda: self.registry.register('congo\n'))
+		self.assertRaises(ValueError, lambda: self.registry.register(1))
+		self.assertIs(self.registry.register(''.join(['con', 'go'])), self.registry.lookup('congo'))
+
+	def test_interned_keys(self):
+		state = self.cls()
+		state[''.join(['ro', 'jo'])] = '5'
+		self.assertIs(state.keys()[0], self.registry.lookup('rojo'))
+		# parsing ignores the registry unless intern_parsed is set
+		self.registry.reset_stats()
+		self.assertIsNot(self.cls(''.join(['con', 'go=1'])).keys()[0], self.registry.lookup('congo'))
+		self.assertEqual(self.registry.hits, 1)
+		self.registry.intern_parsed = True
+		first = self.cls(''.join(['con', 'go=1,foo=2']))
+		second = self.cls(''.join(['con', 'go=3,foo=4']))
+		self.assertIs(first.keys()[0], second.keys()[0])
+		self.assertIs(first.keys()[0], self.registry.lookup('congo'))
+
+	def test_hit_rate(self):
+		self.registry.reset_stats()
+		self.assertEqual(self.registry.hit_rate(), 0.0)
+		self.registry.intern_parsed = True
+		self.cls('congo=1,rojo=2,foo=3,tenant@system=4')
+		self.assertEqual(self.registry.hits, 3)
+		self.assertEqual(self.registry.misses, 1)
+		self.assertEqual(self.registry.hit_rate(), 0.75)
+
+	def test_same_validation(self):
+		for intern_parsed in (False, True):
+			self.registry.intern_parsed = intern_parsed
+			for header in HEADERS:
+				try:
+					expected = Tracestate(header).to_string()
+				except ValueError:
+					expected = None
+				try:
+					actual = self.cls(header).to_string()
+				except ValueError:
+					actual = None
+				self.assertEqual(actual, expected, header)
+
 if __name__ == '__main__':
 	unittest.main()
@@ -1,13 +1,22 @@
+from binascii import unhexlify
 import re
-import uuid
+from .failure import ParseFailure
+from .idgenerator import BufferedRandomIdGenerator
 
 class BaseTraceparent(object):
 	_VERSION_FORMAT_RE = re.compile('^[0-9a-f]{2}$')
 	_TRACE_ID_FORMAT_RE = re.compile('^[0-9a-f]{32}$')
 	_PARENT_ID_FORMAT_RE = re.compile('^[0-9a-f]{16}$')
 	_TRACE_FLAGS_FORMAT_RE = re.compile('^[0-9a-f]{2}$')
+	# version 00 headers are by far the most common, and have a fixed layout of 55 characters
+	_VERSION_00_FORMAT_RE = re.compile('00-[0-9a-f]{32}-[0-9a-f]{16}-[0-9a-f]{2}')
+	_VERSION_00_BYTES_FORMAT_RE = re.compile(b'00-[0-9a-f]{32}-[0-9a-f]{16}-[0-9a-f]{2}')
 	_ZERO_TRACE_ID = b'\0' * 16
 	_ZERO_PARENT_ID = b'\0' * 8
+	FLAG_SAMPLED = 0x01
+	FLAG_RANDOM = 0x02
+	# set to a ParseCache to reuse the result of from_string for repeated str or bytes values
+	parse_cache = None
 
 	def __init__(self, version = 0, trace_id = None, parent_id = None, trace_flags = 0, *_residue):
 		self.version = version
@@ -24,16 +33,112 @@ class BaseTraceparent(object):
 
 	@classmethod
 	def from_string(cls, value):
-		if not isinstance(value, str):
-			raise ValueError('value must be a string')
+		cache = cls.parse_cache
+		# values with less than 4 fields get their missing ids from the parser (e.g. Traceparent.id_generator), which
+		# must not be repeated by later hits, the cached instance is never handed out so setters cannot change it
+		if cache is not None and isinstance(value, (str, bytes)) and value.count('-' if isinstance(value, str) else b'-') >= 3:
+			return cache.get((cls, value), cls._from_string, value)._copy()
+		return cls._from_string(value)
+
+	@classmethod
+	def _from_string(cls, value):
+		if isinstance(value, (bytes, bytearray, memoryview)):
+			# raw header values (e.g. from ASGI) are validated in place and decoded from views of the buffer
+			if len(value) == 55 and cls._VERSION_00_BYTES_FORMAT_RE.fullmatch(value):
+				view = memoryview(value)
+				return cls._from_fields(b'\0', unhexlify(view[3:35]), unhexlify(view[36:52]), unhexlify(view[53:55]))
+			try:
+				value = str(value, 'ascii')
+			except UnicodeDecodeError:
+				raise ValueError('value must only contain ascii characters')
+		elif not isinstance(value, str):
+			raise ValueError('value must be a string or a bytes-like object')
+		if len(value) == 55 and cls._VERSION_00_FORMAT_RE.fullmatch(value):
+			raw = bytes.fromhex(value.replace('-', ' '))
+			traceparent = cls._from_fields(raw[0:1], raw[1:17], raw[17:25], raw[25:26])
+			# a matching value is already in canonical form
+			traceparent._string = value
+			return traceparent
 		value = value.split('-')
 		return cls(*value)
 
+	@classmethod
+	def try_parse(cls, value):
+		'''
+		same as from_string, but returns a ParseFailure instead of raising ValueError, without formatting any message
+		'''
+		if isinstance(value, (bytes, bytearray, memoryview)):
+			if len(value) == 55 and cls._VERSION_00_BYTES_FORMAT_RE.fullmatch(value):
+				view = memoryview(value)
+				trace_id = unhexlify(view[3:35])
+				parent_id = unhexlify(view[36:52])
+				failure = cls._check_fields(0, trace_id, parent_id, 4)
+				return failure or cls._from_fields(b'\0', trace_id, parent_id, unhexlify(view[53:55]))
+			if not bytes(value).isascii():
+				return ParseFailure.NON_ASCII
+			value = str(value, 'ascii')
+		elif not isinstance(value, str):
+			return ParseFailure.UNSUPPORTED_TYPE
+		if len(value) == 55 and cls._VERSION_00_FORMAT_RE.fullmatch(value):
+			raw = bytes.fromhex(value.replace('-', ' '))
+			failure = cls._check_fields(0, raw[1:17], raw[17:25], 4)
+			if failure:
+				return failure
+			traceparent = cls._from_fields(raw[0:1], raw[1:17], raw[17:25], raw[25:26])
+			traceparent._string = value
+			return traceparent
+		# the same checks as the setters, in the same order, missing fields keep their defaults
+		fields = value.split('-')
+		count = len(fields)
+		if not cls._VERSION_FORMAT_RE.fullmatch(fields[0]):
+			return ParseFailure.VERSION_FORMAT
+		version = bytes.fromhex(fields[0])[0]
+		if version == 0xff:
+			return ParseFailure.VERSION_FORBIDDEN
+		trace_id = parent_id = None
+		if count > 1:
+			if not cls._TRACE_ID_FORMAT_RE.fullmatch(fields[1]):
+				return ParseFailure.TRACE_ID_FORMAT
+			trace_id = bytes.fromhex(fields[1])
+		if count > 2:
+			if not cls._PARENT_ID_FORMAT_RE.fullmatch(fields[2]):
+				return ParseFailure.PARENT_ID_FORMAT
+			parent_id = bytes.fromhex(fields[2])
+		if count > 3 and not cls._TRACE_FLAGS_FORMAT_RE.fullmatch(fields[3]):
+			return ParseFailure.TRACE_FLAGS_FORMAT
+		return cls._check_fields(version, trace_id, parent_id, count) or cls(*fields)
+
+	@classmethod
+	def _check_fields(cls, version, trace_id, parent_id, count):
+		# the rules of subclasses on top of the field formats, for try_parse, trace_id and parent_id are None if missing
+		return None
+
+	@classmethod
+	def _from_fields(cls, version, trace_id, parent_id, trace_flags):
+		# fields are already validated and decoded, skip the setters
+		self = cls.__new__(cls)
+		self._version = version
+		self._trace_id = trace_id
+		self._parent_id = parent_id
+		self._trace_flags = trace_flags
+		self._residue = ()
+		self._string = None
+		return self
+
+	def _copy(self):
+		# fields are immutable bytes, a shallow copy is enough
+		copy = object.__new__(type(self))
+		copy.__dict__.update(self.__dict__)
+		return copy
+
 	def to_string(self):
-		retval = '{}-{}-{}-{}'.format(self._version.hex(), self._trace_id.hex(), self._parent_id.hex(), self._trace_flags.hex())
-		if self._residue:
-			retval += '-' + '-'.join(self._residue)
-		return retval
+		# cached until one of the setters changes a field
+		if self._string is None:
+			retval = '{}-{}-{}-{}'.format(self._version.hex(), self._trace_id.hex(), self._parent_id.hex(), self._trace_flags.hex())
+			if self._residue:
+				retval += '-' + '-'.join(self._residue)
+			self._string = retval
+		return self._string
 
 	def get_version(self):
 		return ord(self._version)
@@ -45,12 +150,13 @@ class BaseTraceparent(object):
 			if version == b'\xff':
 				raise ValueError('version 255 is now allowed')
 			self._version = version
+			self._string = None
 		elif isinstance(version, int):
 			if version < 0 or version > 254:
 				raise ValueError('version must be within range [0, 255)')
 			self.set_version(bytes([version]))
 		elif isinstance(version, str):
-			if not self._VERSION_FORMAT_RE.match(version):
+			if not self._VERSION_FORMAT_RE.fullmatch(version):
 				raise ValueError('version {!r} does not match {}'.format(version, self._VERSION_FORMAT_RE))
 			self.set_version(bytes.fromhex(version))
 		else:
@@ -66,8 +172,9 @@ class BaseTraceparent(object):
 			if len(trace_id) != 16:
 				raise ValueError('trace_id must contain 16 bytes')
 			self._trace_id = trace_id
+			self._string = None
 		elif isinstance(trace_id, str):
-			if not self._TRACE_ID_FORMAT_RE.match(trace_id):
+			if not self._TRACE_ID_FORMAT_RE.fullmatch(trace_id):
 				raise ValueError('trace_id does not match {}'.format(self._TRACE_ID_FORMAT_RE))
 			self.set_trace_id(bytes.fromhex(trace_id))
 		else:
@@ -83,8 +190,9 @@ class BaseTraceparent(object):
 			if len(parent_id) != 8:
 				raise ValueError('parent_id must contain 8 bytes')
 			self._parent_id = parent_id
+			self._string = None
 		elif isinstance(parent_id, str):
-			if not self._PARENT_ID_FORMAT_RE.match(parent_id):
+			if not self._PARENT_ID_FORMAT_RE.fullmatch(parent_id):
 				raise ValueError('parent_id does not match {}'.format(self._PARENT_ID_FORMAT_RE))
 			self.set_parent_id(bytes.fromhex(parent_id))
 		else:
@@ -98,12 +206,13 @@ class BaseTraceparent(object):
 			if len(trace_flags) != 1:
 				raise ValueError('trace_flags must be a single byte')
 			self._trace_flags = trace_flags
+			self._string = None
 		elif isinstance(trace_flags, int):
 			if trace_flags < 0 or trace_flags > 255:
 				raise ValueError('trace_flags must be within range [0, 255]')
 			self.set_trace_flags(bytes([trace_flags]))
 		elif isinstance(trace_flags, str):
-			if not self._TRACE_FLAGS_FORMAT_RE.match(trace_flags):
+			if not self._TRACE_FLAGS_FORMAT_RE.fullmatch(trace_flags):
 				raise ValueError('trace_flags {!r} does not match {}'.format(trace_flags, self._TRACE_FLAGS_FORMAT_RE))
 			self.set_trace_flags(bytes.fromhex(trace_flags))
 		else:
@@ -115,13 +224,59 @@ class BaseTraceparent(object):
 	trace_flags = property(get_trace_flags, set_trace_flags)
 
 class Traceparent(BaseTraceparent):
+	# missing ids are taken from here, replace it (on the class or an instance) to plug in a different IdGenerator
+	id_generator = BufferedRandomIdGenerator()
+
 	def __init__(self, version = 0, trace_id = None, parent_id = None, trace_flags = 0):
 		if trace_id is None:
-			trace_id = uuid.uuid1().hex
+			trace_id = self.id_generator.generate_trace_id()
 		if parent_id is None:
-			parent_id = uuid.uuid4().hex[:16]
+			parent_id = self.id_generator.generate_parent_id()
 		super().__init__(version, trace_id, parent_id, trace_flags)
 
+	@classmethod
+	def new_trace(cls, trace_flags = 0):
+		'''
+		starts a new trace, the random-trace-id flag is set if the id_generator guarantees random trace ids
+		'''
+		if cls.id_generator.random_trace_id:
+			trace_flags |= cls.FLAG_RANDOM
+		return cls(0, None, None, trace_flags)
+
+	def child(self, parent_id = None):
+		'''
+		returns a copy with a new parent_id, taken from id_generator if not provided, for propagating to the next hop
+		'''
+		child = self._from_fields(self._version, self._trace_id, self._parent_id, self._trace_flags)
+		if parent_id is None:
+			child._parent_id = self.id_generator.generate_parent_id()
+		else:
+			child.parent_id = parent_id
+		# only the 16 parent_id characters differ from the version 00 header of self
+		template = self.to_string()
+		child._string = template[:36] + child._parent_id.hex() + template[52:]
+		return child
+
+	@classmethod
+	def _check_fields(cls, version, trace_id, parent_id, count):
+		if count > 4:
+			return ParseFailure.FIELD_COUNT
+		if version != 0:
+			return ParseFailure.VERSION_UNSUPPORTED
+		if trace_id == cls._ZERO_TRACE_ID:
+			return ParseFailure.TRACE_ID_ZERO
+		if parent_id == cls._ZERO_PARENT_ID:
+			return ParseFailure.PARENT_ID_ZERO
+		return None
+
+	@classmethod
+	def _from_fields(cls, version, trace_id, parent_id, trace_flags):
+		if trace_id == cls._ZERO_TRACE_ID:
+			raise ValueError('all zero trace_id is not allowed')
+		if parent_id == cls._ZERO_PARENT_ID:
+			raise ValueError('all zero parent_id is not allowed')
+		return super()._from_fields(version, trace_id, parent_id, trace_flags)
+
 	def set_version(self, version):
 		if version != 0 and version != b'\0' and version != '00':
 			raise ValueError('unsupported version')
@@ -144,3 +299,139 @@ class Traceparent(BaseTraceparent):
 	trace_id = property(BaseTraceparent.get_trace_id, set_trace_id)
 	parent_id = property(BaseTraceparent.get_parent_id, set_parent_id)
 	trace_flags = property(BaseTraceparent.get_trace_flags, set_trace_flags)
+
+class CompactTraceparent(object):
+	'''
+	Traceparent packed into a single 26 bytes buffer (version, trace_id, parent_id, trace_flags) without a per instance __dict__.
+	Validation is delegated to Traceparent, the property API is the same.
+	'''
+	__slots__ = ('_data',)
+
+	def __init__(self, version = 0, trace_id = None, parent_id = None, trace_flags = 0):
+		self._pack(Traceparent(version, trace_id, parent_id, trace_flags))
+
+	def __repr__(self):
+		return '{}({!r})'.format(type(self).__name__, str(self))
+
+	def __str__(self):
+		return self.to_string()
+
+	@classmethod
+	def from_string(cls, value):
+		return cls.from_traceparent(Traceparent.from_string(value))
+
+	@classmethod
+	def from_traceparent(cls, traceparent):
+		# any BaseTraceparent is accepted, so it is held to the rules of Traceparent here
+		if traceparent._residue:
+			raise ValueError('traceparent with more than 4 fields cannot be packed')
+		cls._check_fields(traceparent._version[0], traceparent._trace_id, traceparent._parent_id)
+		self = cls.__new__(cls)
+		self._pack(traceparent)
+		return self
+
+	@staticmethod
+	def _check_fields(version, trace_id, parent_id):
+		failure = Traceparent._check_fields(version, trace_id, parent_id, 4)
+		if failure:
+			raise ValueError('illegal traceparent ({})'.format(failure.name))
+
+	def to_traceparent(self):
+		data = self._data
+		return Traceparent._from_fields(data[0:1], data[1:17], data[17:25], data[25:26])
+
+	def to_string(self):
+		data = self._data
+		return '{}-{}-{}-{}'.format(data[0:1].hex(), data[1:17].hex(), data[17:25].hex(), data[25:26].hex())
+
+	def _pack(self, traceparent):
+		self._data = traceparent._version + traceparent._trace_id + traceparent._parent_id + traceparent._trace_flags
+
+	def _update(self, name, value):
+		traceparent = self.to_traceparent()
+		setattr(traceparent, name, value)
+		self._pack(traceparent)
+
+	def get_version(self):
+		return self._data[0]
+
+	def set_version(self, version):
+		self._update('version', version)
+
+	def get_trace_id(self):
+		return self._data[1:17]
+
+	def set_trace_id(self, trace_id):
+		self._update('trace_id', trace_id)
+
+	def get_parent_id(self):
+		return self._data[17:25]
+
+	def set_parent_id(self, parent_id):
+		self._update('parent_id', parent_id)
+
+	def get_trace_flags(self):
+		return self._data[25]
+
+	def set_trace_flags(self, trace_flags):
+		self._update('trace_flags', trace_flags)
+
+	version = property(get_version, set_version)
+	trace_id = property(get_trace_id, set_trace_id)
+	parent_id = property(get_parent_id, set_parent_id)
+	trace_flags = property(get_trace_flags, set_trace_flags)
+
+class FrozenTraceparent(CompactTraceparent):
+	'''
+	Immutable CompactTraceparent which compares and hashes by its 26 bytes, for use as a dict key or set member.
+	'''
+	__slots__ = ()
+
+	def __eq__(self, other):
+		if isinstance(other, FrozenTraceparent):
+			return self._data == other._data
+		return NotImplemented
+
+	def __hash__(self):
+		return hash(self._data)
+
+	def __reduce__(self):
+		# copy and pickle would otherwise restore _data through the blocked __setattr__
+		return (type(self).from_bytes, (self._data,))
+
+	@classmethod
+	def from_bytes(cls, data):
+		'''
+		creates a traceparent from the 26 bytes of to_bytes, validated like Traceparent
+		'''
+		if not isinstance(data, bytes) or len(data) != 26:
+			raise ValueError('data must contain 26 bytes')
+		cls._check_fields(data[0], data[1:17], data[17:25])
+		self = cls.__new__(cls)
+		object.__setattr__(self, '_data', data)
+		return self
+
+	def to_bytes(self):
+		return self._data
+
+	def __setattr__(self, name, value):
+		# the hash is that of _data, which must not change while the instance is a key
+		raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+	def __delattr__(self, name):
+		raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+	def _pack(self, traceparent):
+		object.__setattr__(self, '_data', traceparent._version + traceparent._trace_id + traceparent._parent_id + traceparent._trace_flags)
+
+	def _update(self, name, value):
+		raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+	def get_trace_id_int(self):
+		return int.from_bytes(self._data[1:17], 'big')
+
+	def get_parent_id_int(self):
+		return int.from_bytes(self._data[17:25], 'big')
+
+	trace_id_int = property(get_trace_id_int)
+	parent_id_int = property(get_parent_id_int)
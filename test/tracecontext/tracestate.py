@@ -1,82 +1,518 @@
 from collections import OrderedDict
+from itertools import chain
 import re
+import sys
+import threading
+from .failure import ParseFailure
+
+class TracestateKeyRegistry(object):
+	'''
+	Table of known tracestate keys. Keys are validated once when registered and interned, setting a known key skips its
+	validation. Parsing matches every key as part of the single regular expression per member of _tokenize, so it
+	ignores the registry unless intern_parsed is set, which makes parsed instances share the registered key objects
+	(saving memory for long lived instances) at the cost of one lookup per member.
+	'''
+	def __init__(self, keys = (), intern_parsed = False):
+		self.intern_parsed = intern_parsed
+		self._keys = {}
+		self.hits = 0
+		self.misses = 0
+		for key in keys:
+			self.register(key)
+
+	def __contains__(self, key):
+		return key in self._keys
+
+	def __len__(self):
+		return len(self._keys)
+
+	def __repr__(self):
+		return '{}({!r})'.format(type(self).__name__, list(self._keys))
+
+	def register(self, key):
+		if not isinstance(key, str):
+			raise ValueError('key must be an instance of str')
+		if not Tracestate._KEY_VALIDATION_RE.fullmatch(key):
+			raise ValueError('illegal key provided')
+		key = sys.intern(key)
+		return self._keys.setdefault(key, key)
+
+	def lookup(self, key):
+		'''
+		returns the registered key object, or None if the key is unknown
+		'''
+		key = self._keys.get(key)
+		if key is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+		return key
+
+	def hit_rate(self):
+		total = self.hits + self.misses
+		return self.hits / total if total else 0.0
+
+	def reset_stats(self):
+		self.hits = 0
+		self.misses = 0
+
+# serializes turning the members of an instance into the shared base of its copies
+_share_lock = threading.Lock()
+
+def _tokenize(string, seen = None, max_members = None):
+	'''
+	Walks a tracestate header once and yields (key, value) for every member, dropping keys in seen (keys which were already
+	yielded if seen is None). OWS around commas and empty members are skipped. Stops after yielding (None, member) for
+	the first illegal member, or (None, None) for the first non-empty member over max_members.
+	'''
+	member_match = Tracestate._MEMBER_TOKEN_RE.match
+	if seen is None:
+		seen = set()
+		add = seen.add
+	else:
+		add = None
+	if max_members is None:
+		max_members = len(string)
+	length = len(string)
+	# OWS is only stripped next to commas, so a header with OWS at its very start is illegal
+	pos = Tracestate._LEADING_SEPARATOR_RE.match(string).end()
+	while pos < length:
+		max_members -= 1
+		if max_members < 0:
+			yield None, None
+			return
+		match = member_match(string, pos)
+		if match is None:
+			end = string.find(',', pos)
+			yield None, string[pos:] if end < 0 else string[pos:end].rstrip(' \t')
+			return
+		key, value = match.groups()
+		if key not in seen:
+			if add:
+				add(key)
+			yield key, value
+		pos = match.end()
+
+def _truncate(items, max_bytes, max_members):
+	# https://www.w3.org/TR/trace-context/#tracestate-limits
+	# entries larger than 128 characters are removed first (from the end), then entries are removed from the end
+	items = list(items)
+	sizes = [len(key) + 1 + len(value) for key, value in items]
+	count = len(items)
+	# every member but the first one is preceded by a comma
+	total = sum(sizes) + count - 1 if count else 0
+	keep = [True] * count
+	idx = count
+	while total > max_bytes and idx > 0:
+		idx -= 1
+		if sizes[idx] > 128:
+			keep[idx] = False
+			count -= 1
+			total -= sizes[idx] + 1 if count else sizes[idx]
+	idx = len(items)
+	while (total > max_bytes or count > max_members) and idx > 0:
+		idx -= 1
+		if keep[idx]:
+			keep[idx] = False
+			count -= 1
+			total -= sizes[idx] + 1 if count else sizes[idx]
+	kept = [item for item, flag in zip(items, keep) if flag]
+	removed = [item for item, flag in zip(items, keep) if not flag]
+	return kept, removed
+
+def _is_valid(count, to_string):
+	if count == 0:
+		return False
+	# combined header length MUST be less than or equal to 512 bytes
+	if len(to_string()) > 512:
+		return False
+	# there can be a maximum of 32 list-members in a list
+	if count > 32:
+		return False
+	return True
 
 class Tracestate(object):
 	_KEY_FORMAT = r'[0-9a-z][_0-9a-z\-\*\/@]{0,255}'
 	_VALUE_FORMAT = r'[\x20-\x2b\x2d-\x3c\x3e-\x7e]{0,255}[\x21-\x2b\x2d-\x3c\x3e-\x7e]'
-	_DELIMITER_FORMAT_RE = re.compile('[ \t]*,[ \t]*')
 	_KEY_VALIDATION_RE = re.compile('^(' + _KEY_FORMAT + ')$')
 	_VALUE_VALIDATION_RE = re.compile('^(' + _VALUE_FORMAT + ')$')
-	_MEMBER_FORMAT_RE = re.compile('^(%s)(=)(%s)$' % (_KEY_FORMAT, _VALUE_FORMAT))
+	# a member with the OWS, commas and empty members which end it, matched at the position of the member by _tokenize
+	_MEMBER_TOKEN_RE = re.compile(r'(%s)=(%s)(?:[ \t]*,[ \t,]*|\Z)' % (_KEY_FORMAT, _VALUE_FORMAT))
+	_LEADING_SEPARATOR_RE = re.compile('(?:[ \t]*,[ \t,]*)?')
+	# set to a TracestateKeyRegistry to skip the validation of known keys in __setitem__, see intern_parsed for parsing
+	key_registry = None
+	# set to a ParseCache to share the members of repeated str or bytes headers between Tracestate(header) instances
+	parse_cache = None
 
 	def __init__(self, *args, **kwds):
+		# members are self._traits followed by the members of the shared, never mutated, self._base which are not shadowed
+		self._base = None
+		# cached header, kept up to date by __setitem__ and pop
+		self._string = None
+		# header of a lazy instance which has not been parsed yet
+		self._raw = None
 		if len(args) == 1 and not kwds:
-			if isinstance(args[0], str):
+			if isinstance(args[0], (str, bytes, bytearray, memoryview)):
 				self._traits = OrderedDict()
-				self.from_string(args[0])
+				cache = self.parse_cache
+				if cache is not None and isinstance(args[0], (str, bytes)):
+					# copy-on-write, the cached members become the base of this instance
+					self._base, self._string = cache.get((type(self), args[0]), self._parse_shared, args[0])
+				else:
+					self.from_string(args[0])
 				return
 			if isinstance(args[0], Tracestate):
-				self._traits = OrderedDict(args[0]._traits)
+				other = args[0]
+				if other._raw is not None:
+					self._raw = other._raw
+					self._traits = OrderedDict()
+					return
+				# copy-on-write, the members of other become a base shared by both instances. Copying the same instance
+				# from several threads at once is safe, modifying an instance while it is being copied is not
+				with _share_lock:
+					if other._base is None:
+						other._base = other._traits
+						other._traits = OrderedDict()
+					self._base = other._base
+					self._traits = OrderedDict(other._traits)
+				self._string = other._string
 				return
 		self._traits = OrderedDict(*args, **kwds)
 
+	@classmethod
+	def lazy(cls, string):
+		'''
+		creates a tracestate which keeps string as is, members are only parsed and validated when they are first read or
+		written (which can raise ValueError), and to_string returns string verbatim as long as nothing was modified.
+		is_valid checks the syntax of the members as well, so a valid instance never forwards a malformed string
+		'''
+		if isinstance(string, (bytes, bytearray, memoryview)):
+			try:
+				string = str(string, 'ascii')
+			except UnicodeDecodeError:
+				raise ValueError('tracestate must only contain ascii characters')
+		elif not isinstance(string, str):
+			raise ValueError('tracestate must be a string or a bytes-like object')
+		self = cls()
+		self._raw = string
+		return self
+
 	def __contains__(self, key):
-		return key in self._traits
+		if self._raw is not None:
+			self._load()
+		return key in self._traits or (self._base is not None and key in self._base)
 
 	def __len__(self):
-		return len(self._traits)
+		if self._raw is not None:
+			self._load()
+		if self._base is None:
+			return len(self._traits)
+		base = self._base
+		return len(self._traits) + len(base) - sum(1 for key in self._traits if key in base)
 
 	def __repr__(self):
 		return '{}({!r})'.format(type(self).__name__, str(self))
 
 	def __getitem__(self, key):
-		return self._traits[key]
+		if self._raw is not None:
+			self._load()
+		try:
+			return self._traits[key]
+		except KeyError:
+			if self._base is None:
+				raise
+		return self._base[key]
 
 	def __setitem__(self, key, value):
+		key = self._validate(key, value)
+		if self._raw is not None:
+			self._load()
+		if self._string is not None:
+			rest = self._remove_member(self._string, key) if key in self else self._string
+			self._string = key + '=' + value + (',' + rest if rest else '')
+		self._traits[key] = value
+		self._traits.move_to_end(key, last = False)
+
+	def __str__(self):
+		return self.to_string()
+
+	@classmethod
+	def _validate(cls, key, value):
 		if not isinstance(key, str):
 			raise ValueError('key must be an instance of str')
-		if not re.match(self._KEY_VALIDATION_RE, key):
+		known = cls.key_registry.lookup(key) if cls.key_registry is not None else None
+		if known is not None:
+			key = known
+		elif not re.match(cls._KEY_VALIDATION_RE, key):
 			raise ValueError('illegal key provided')
 		if not isinstance(value, str):
 			raise ValueError('value must be an instance of str')
-		if not re.match(self._VALUE_VALIDATION_RE, value):
+		if not re.match(cls._VALUE_VALIDATION_RE, value):
 			raise ValueError('illegal value provided')
-		self._traits[key] = value
-		self._traits.move_to_end(key, last = False)
+		return key
 
-	def __str__(self):
-		return self.to_string()
+	@staticmethod
+	def _remove_member(string, key):
+		# keys and values can contain neither ',' nor '=', so ',key=' only matches the start of that member
+		if string.startswith(key + '='):
+			start = 0
+		else:
+			start = string.find(',' + key + '=')
+			if start < 0:
+				return string
+		end = string.find(',', start + 1)
+		if end < 0:
+			return string[:start]
+		if start == 0:
+			return string[end + 1:]
+		return string[:start] + string[end:]
 
-	def from_string(self, string):
-		for member in re.split(self._DELIMITER_FORMAT_RE, string):
-			if member:
-				match = self._MEMBER_FORMAT_RE.match(member)
-				if not match:
-					raise ValueError('illegal key-value format {!r}'.format(member))
-				key, eq, value = match.groups()
-				if key not in self._traits:
-					self._traits[key] = value
-					# If key is already in self._traits, the incoming tracestate header contained a duplicated key.
-					# According to the spec, two behaviors are valid: Either pass on the duplicated key as-is or drop
-					# it. We opt for dropping it.
+	def _items(self):
+		if self._raw is not None:
+			self._load()
+		if self._base is None:
+			return self._traits.items()
+		traits = self._traits
+		return chain(traits.items(), ((key, value) for key, value in self._base.items() if key not in traits))
+
+	def _load(self):
+		# parses the header of a lazy instance
+		raw = self._raw
+		self._raw = None
+		try:
+			self.from_string(raw)
+		except ValueError:
+			# keep failing on every access instead of exposing the members parsed so far
+			self._traits.clear()
+			self._raw = raw
+			raise
+
+	def _materialize(self):
+		# merges the shared base into the owned members, before operations which need a single OrderedDict
+		if self._base is not None:
+			traits = self._traits
+			for key, value in self._base.items():
+				if key not in traits:
+					traits[key] = value
+			self._base = None
+
+	def from_string(self, string, max_bytes = None, max_members = None):
+		'''
+		adds the members of string, max_bytes and max_members are budgets for the header (including OWS and empty members)
+		and its non-empty members, scanning stops with ValueError as soon as one is exceeded
+		'''
+		if self._raw is not None:
+			self._load()
+		self._materialize()
+		self._string = None
+		if isinstance(string, (bytes, bytearray, memoryview)):
+			if max_bytes is not None and len(string) > max_bytes:
+				raise ValueError('tracestate exceeds {} bytes'.format(max_bytes))
+			try:
+				string = str(string, 'ascii')
+			except UnicodeDecodeError:
+				raise ValueError('tracestate must only contain ascii characters')
+		failure, member = self._parse(string, max_bytes, max_members)
+		if failure is ParseFailure.SIZE_LIMIT:
+			raise ValueError('tracestate exceeds {} bytes or {} members'.format(max_bytes, max_members))
+		if failure is not None:
+			raise ValueError('illegal key-value format {!r}'.format(member))
 		return self
 
+	@classmethod
+	def try_parse(cls, string, max_bytes = None, max_members = None):
+		'''
+		same as Tracestate().from_string(string, max_bytes, max_members), but returns a ParseFailure instead of raising
+		ValueError, without formatting any message
+		'''
+		if isinstance(string, (bytes, bytearray, memoryview)):
+			if max_bytes is not None and len(string) > max_bytes:
+				return ParseFailure.SIZE_LIMIT
+			if not bytes(string).isascii():
+				return ParseFailure.NON_ASCII
+			string = str(string, 'ascii')
+		elif not isinstance(string, str):
+			return ParseFailure.UNSUPPORTED_TYPE
+		self = cls()
+		failure, member = self._parse(string, max_bytes, max_members)
+		return failure or self
+
+	@classmethod
+	def _parse_shared(cls, string):
+		# the members and header of string for parse_cache, the members are only ever used as a never mutated base
+		self = cls()
+		self.from_string(string)
+		return self._traits, self.to_string()
+
+	def _parse(self, string, max_bytes = None, max_members = None):
+		# adds the members of string, returns (ParseFailure, illegal member) or (None, None), members before it are kept
+		if max_bytes is not None and len(string) > max_bytes:
+			return ParseFailure.SIZE_LIMIT, None
+		registry = self.key_registry
+		if registry is not None and not registry.intern_parsed:
+			registry = None
+		known_keys = registry._keys if registry is not None else None
+		hits = misses = 0
+		traits = self._traits
+		failure = member = None
+		for key, value in _tokenize(string, traits, max_members):
+			if key is None:
+				failure = ParseFailure.SIZE_LIMIT if value is None else ParseFailure.MEMBER_FORMAT
+				member = value
+				break
+			if known_keys is not None:
+				# only shares the registered key object, the key already matched the key pattern within the member token
+				known = known_keys.get(key)
+				if known is None:
+					misses += 1
+				else:
+					hits += 1
+					key = known
+			# Keys already in self._traits are duplicated keys in the incoming tracestate header. According to the spec,
+			# two behaviors are valid: Either pass on the duplicated key as-is or drop it. We opt for dropping it.
+			traits[key] = value
+		if registry is not None:
+			registry.hits += hits
+			registry.misses += misses
+		return failure, member
+
+	def keys(self):
+		'''
+		returns the keys of the members in header order
+		'''
+		return [key for key, value in self._items()]
+
 	def to_string(self):
-		return ','.join(map(lambda key: key + '=' + self[key], self._traits))
+		if self._raw is not None:
+			return self._raw
+		if self._string is None:
+			self._string = ','.join(map(lambda item: item[0] + '=' + item[1], self._items()))
+		return self._string
 
 	# make this an optional choice instead of enforcement during put/update
 	# if the tracestate value size is bigger than 512 characters, the tracer
 	# CAN decide to forward the tracestate
 	def is_valid(self):
-		if len(self) == 0:
-			return False
-		# combined header length MUST be less than or equal to 512 bytes
-		if len(self.to_string()) > 512:
-			return False
-		# there can be a maximum of 32 list-members in a list
-		if len(self) > 32:
-			return False
-		return True
+		if self._raw is not None:
+			raw = self._raw
+			# the raw header is an upper bound of both the length and the member count, if neither limit is exceeded the
+			# members are only checked for their syntax, without building them
+			if len(raw) <= 512 and raw.count(',') < 32:
+				valid = False
+				for key, value in _tokenize(raw):
+					if key is None:
+						return False
+					valid = True
+				return valid
+			try:
+				self._load()
+			except ValueError:
+				return False
+		return _is_valid(len(self), self.to_string)
+
+	def truncate(self, max_bytes = 512, max_members = 32):
+		'''
+		removes whole members until the header fits into max_bytes and max_members, entries larger than 128 characters
+		first, then from the end, and returns the removed (key, value) pairs
+		'''
+		if self._raw is not None and len(self._raw) <= max_bytes and self._raw.count(',') < max_members:
+			return []
+		kept, removed = _truncate(self._items(), max_bytes, max_members)
+		if removed:
+			self._traits = OrderedDict(kept)
+			self._base = None
+			self._string = None
+		return removed
+
+	def pop(self):
+		if self._raw is not None:
+			self._load()
+		self._materialize()
+		item = self._traits.popitem()
+		if self._string is not None:
+			idx = self._string.rfind(',')
+			self._string = self._string[:idx] if idx >= 0 else ''
+		return item
+
+class CompactTracestate(object):
+	'''
+	Tracestate stored as a flat (key, value, key, value, ...) tuple without a per instance __dict__ or OrderedDict.
+	Copies share the tuple, validation is delegated to Tracestate.
+	'''
+	__slots__ = ('_items',)
+
+	def __init__(self, *args, **kwds):
+		if len(args) == 1 and not kwds and isinstance(args[0], CompactTracestate):
+			self._items = args[0]._items
+			return
+		self._items = self._flatten(Tracestate(*args, **kwds))
+
+	def __contains__(self, key):
+		return self._index(key) >= 0
+
+	def __len__(self):
+		return len(self._items) // 2
+
+	def __repr__(self):
+		return '{}({!r})'.format(type(self).__name__, str(self))
+
+	def __getitem__(self, key):
+		idx = self._index(key)
+		if idx < 0:
+			raise KeyError(key)
+		return self._items[idx + 1]
+
+	def __setitem__(self, key, value):
+		key = Tracestate._validate(key, value)
+		items = self._items
+		idx = self._index(key)
+		if idx >= 0:
+			items = items[:idx] + items[idx + 2:]
+		self._items = (key, value) + items
+
+	def __str__(self):
+		return self.to_string()
+
+	@staticmethod
+	def _flatten(tracestate):
+		return tuple(chain.from_iterable(tracestate._items()))
+
+	def _index(self, key):
+		items = self._items
+		for idx in range(0, len(items), 2):
+			if items[idx] == key:
+				return idx
+		return -1
+
+	def _pairs(self):
+		items = self._items
+		return zip(items[0::2], items[1::2])
+
+	def from_string(self, string):
+		self._items = self._flatten(Tracestate(self._pairs()).from_string(string))
+		return self
+
+	def keys(self):
+		return list(self._items[0::2])
+
+	def to_tracestate(self):
+		return Tracestate(self._pairs())
+
+	def to_string(self):
+		return ','.join(map(lambda pair: pair[0] + '=' + pair[1], self._pairs()))
+
+	def is_valid(self):
+		return _is_valid(len(self), self.to_string)
+
+	def truncate(self, max_bytes = 512, max_members = 32):
+		kept, removed = _truncate(self._pairs(), max_bytes, max_members)
+		if removed:
+			self._items = tuple(chain.from_iterable(kept))
+		return removed
 
 	def pop(self):
-		return self._traits.popitem()
+		items = self._items
+		if not items:
+			raise KeyError('dictionary is empty')
+		self._items = items[:-2]
+		return items[-2], items[-1]